@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import argparse, random, time
+from resources.pedigree_data import familyChildren, familyDistances, familyWithin
+
+def syntheticParents(size, seed):
+    # A pedigree with size people: founders, then generations of random couples with 1-5 children
+    # each, plus some spouses who marry in from outside
+    generator = random.Random(seed)
+    parents = [() for i in xrange(max(2,size/200))]
+    current = range(len(parents))
+    while len(parents) < size:
+        generator.shuffle(current)
+        nextGeneration = []
+        for x in xrange(0,len(current)-1,2):
+            for c in xrange(generator.randint(1,5)):
+                if len(parents) < size:
+                    nextGeneration.append(len(parents))
+                    parents.append((current[x],current[x+1]))
+        for i in xrange(max(2,len(nextGeneration)/3)):
+            if len(parents) < size:
+                nextGeneration.append(len(parents))
+                parents.append(())
+        current = nextGeneration
+    return parents
+
+def timeRuns(function, arguments):
+    start = time.time()
+    results = [function(*a) for a in arguments]
+    return time.time()-start,results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times the traversal kernels in resources/kernels.py against the pure Python versions on synthetic pedigrees, and checks that they give the same answers.')
+    parser.add_argument('--sizes', type=int, dest="sizes", default=[10000,100000,1000000], nargs='+',
+                        help='Numbers of people in the synthetic pedigrees. Default is 10000 100000 1000000.')
+    parser.add_argument('--sources', type=int, dest="sources", default=20,
+                        help='Number of people to start traversals from in each pedigree. Default is 20.')
+    parser.add_argument('--affected', type=float, dest="affected", default=0.05,
+                        help='Proportion of people to treat as affected (the targets of the meioses traversals). Default is 0.05.')
+    parser.add_argument('--seed', type=int, dest="seed", default=0, help='Random seed. Default is 0.')
+    
+    args = parser.parse_args()
+    
+    try:
+        from resources import kernels
+    except ImportError:
+        parser.error('The kernels need numpy.')
+    layers = sorted(kernels.LAYERS.iterkeys())
+    if not 'numba' in layers:
+        print "numba isn't installed, so only the numpy kernels will be timed."
+    
+    print 'people\ttraversal\tpython\t%s' % '\t'.join(layers)
+    for size in args.sizes:
+        generator = random.Random(args.seed)
+        parents = syntheticParents(size, args.seed)
+        children = familyChildren(parents)
+        targets = set(generator.sample(xrange(size), int(size*args.affected)))
+        sources = [(generator.choice(list(targets)),) for s in xrange(args.sources)]
+        # The original founders, rather than spouses who married in later on
+        founders = range(next(i for i,ps in enumerate(parents) if len(ps) > 0))
+        roots = [(generator.choice(founders),float('inf')) for s in xrange(args.sources)]
+        people = [(generator.randrange(size),3) for s in xrange(args.sources)]
+        
+        for name,python,kernel,arguments,sameAnswers in [('meioses',
+                                                          lambda source: familyDistances(parents, children, source, targets),
+                                                          lambda layer: kernels.familyDistanceFunction(parents, children, targets, layer),
+                                                          sources,
+                                                          lambda a,b: a == b),
+                                                         ('descendants',
+                                                          lambda person, level: familyWithin(children, person, level),
+                                                          lambda layer: kernels.familyWithinFunction(children, layer),
+                                                          roots,
+                                                          lambda a,b: a == b),
+                                                         ('3 generations up',
+                                                          lambda person, level: familyWithin(parents, person, level),
+                                                          lambda layer: kernels.familyWithinFunction(parents, layer),
+                                                          people,
+                                                          lambda a,b: a == b)]:
+            pythonTime,expected = timeRuns(python, arguments)
+            times = []
+            for layer in layers:
+                function = kernel(layer)
+                # The first call pays for numba's compiling; that's once per process, so leave it out
+                function(*arguments[0])
+                kernelTime,results = timeRuns(function, arguments)
+                if not all(sameAnswers(a,b) for a,b in zip(expected, results)):
+                    raise Exception('The %s kernels gave different answers for %s.' % (layer,name))
+                times.append('%.3fs (%.1fx)' % (kernelTime,pythonTime/max(kernelTime,1e-9)))
+            print '%i\t%s\t%.3fs\t%s' % (size,name,pythonTime,'\t'.join(times))
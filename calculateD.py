@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import argparse, os
+import argparse, os, sys
 from resources.pedigree_data import Pedigree, gexf_node_attribute_mapper
 
 def tick(newMessage=None,increment=1):
@@ -13,21 +13,122 @@ if __name__ == '__main__':
     parser.add_argument('--zeroMissingLines', type=str, dest="zeroMissing", required=False, nargs="?", default="False", const="True",
                         help="If True, this will only calculate values for lines in the file (and replace missing parents with zeros). " + 
                         "Otherwise, lines will be added for any individual mentioned in the file.")
+    parser.add_argument('--processes', type=int, dest="numProcesses", default=1,
+                        help="Number of processes to use; connected families are counted and calculated in parallel, largest first. Default is 1.")
+    parser.add_argument('--top', type=int, dest="top", default=0,
+                        help="If greater than zero, only find the ancestors with the highest d (or --topBy) and write them, ranked, to the output path instead of the whole file. Default is 0.")
+    parser.add_argument('--topBy', type=str, dest="topBy", default='nicki_d', choices=['nicki_d','n_local_aff'],
+                        help="What to rank ancestors by for --top. Default is nicki_d.")
+    parser.add_argument('--permutations', type=int, dest="permutations", default=0,
+                        help="If greater than zero, shuffle affected statuses this many times and add empirical p-values for d (requires numpy). Default is 0.")
+    parser.add_argument('--stratifyByGeneration', type=str, dest="stratify", required=False, nargs="?", default="False", const="True",
+                        help="If True, affected statuses are only shuffled within generations for --permutations.")
+    parser.add_argument('--geneDrops', type=int, dest="geneDrops", default=0,
+                        help="If greater than zero, simulate this many gene drops through each family and add null means and p-values for n_local_aff and d (requires numpy). Default is 0.")
+    parser.add_argument('--heritability', type=float, dest="heritability", default=0.5,
+                        help="Heritability of the liability used to simulate affected statuses for --geneDrops. Default is 0.5.")
+    parser.add_argument('--enrichment', type=str, dest="enrichment", required=False, nargs="?", default="False", const="True",
+                        help="If True, add each ancestor's expected number of affected descendants, given the rates in their descendants' strata, and a p-value for the excess (requires numpy).")
+    parser.add_argument('--enrichmentStrata', type=str, dest="enrichmentStrata", default=['generation'], nargs='+',
+                        help="Columns to stratify the --enrichment rates by; \"column:width\" bins a numeric column (like age:10). Default is generation.")
+    parser.add_argument('--enrichmentTest', type=str, dest="enrichmentTest", default='poisson', choices=['poisson','binomial'],
+                        help="Whether --enrichment p-values come from a Poisson or a binomial test. Default is poisson.")
+    parser.add_argument('--maxExactAffected', type=int, dest="maxExactAffected", default=None,
+                        help="If set, d is estimated from a sample of pairs (with a 95%% confidence interval) for anyone with more affected descendants than this.")
+    parser.add_argument('--pairBudget', type=int, dest="pairBudget", default=100000,
+                        help="Roughly how many pairs to sample for each estimated d. Default is 100000.")
+    parser.add_argument('--seed', type=int, dest="seed", default=0, help="Random seed for --permutations, --geneDrops, --gif and --maxExactAffected. Default is 0.")
+    parser.add_argument('--resume', type=str, dest="resume", required=False, nargs="?", default="False", const="True",
+                        help="If True, pick up from the checkpoint left by an earlier run that was interrupted.")
+    parser.add_argument('--checkpoint', type=str, dest="checkpoint", default=None,
+                        help="Where to save progress while counting and calculating d. Default is the output path with .checkpoint on the end.")
+    parser.add_argument('--checkpointInterval', type=int, dest="checkpointInterval", default=300,
+                        help="Seconds between checkpoints. Default is 300.")
+    parser.add_argument('--kinship', type=str, dest="kinship", default=None,
+                        help="If set, also write the kinship coefficient for every related pair of affecteds to this tab-separated file.")
+    parser.add_argument('--gif', type=str, dest="gif", default=None,
+                        help="If set, also write a summary of the Genealogical Index of Familiality for the affecteds, with a p-value from generation-matched control sets, to this tab-separated file (requires numpy).")
+    parser.add_argument('--gifResamples', type=int, dest="gifResamples", default=1000,
+                        help="Number of control sets to draw for --gif. Default is 1000.")
+    parser.add_argument('--trim', type=str, dest="trim", required=False, nargs="?", default="False", const="True",
+                        help="If True, leave uninformative people out of the output: unaffected people with no affected descendants, and unaffected founders with only one child (ego-pa-ma output only).")
+    parser.add_argument('--cache', type=str, dest="cache", default=None,
+                        help="If set, keep each family's results in this file between runs, so that only families that have changed since the last run get recalculated.")
+    parser.add_argument('--queue', type=str, dest="queue", default=None,
+                        help="If set, hand counting and calculating d out through a work queue in this directory to queueWorker.py processes, which can run on any host that can see it, instead of --processes.")
+    parser.add_argument('--queueUnitSize', type=int, dest="queueUnitSize", default=10000,
+                        help="Families with more people than this get split into separate --queue work units of this many people (unless d is being estimated with --maxExactAffected). Default is 10000.")
+    parser.add_argument('--queueTimeout', type=int, dest="queueTimeout", default=600,
+                        help="Seconds that a --queue worker can go without checking in before its work unit is given to someone else. Default is 600.")
     
     for k,d in Pedigree.REQUIRED_KEYS.iteritems():
-        parser.add_argument('--%s'%k, type=str, dest=k, default=d, help='Override the column header for %s. Default is "%s".' % (k,d))
+        if k == 'affected':
+            parser.add_argument('--%s'%k, type=str, dest=k, default=[d], nargs='+',
+                                help='Override the column header for %s. Give several columns to calculate %s_<column> and %s_<column> for each of them in one pass. Default is "%s".' %
+                                (k,Pedigree.RESERVED_KEYS['n_local_aff'],Pedigree.RESERVED_KEYS['nicki_d'],d))
+        else:
+            parser.add_argument('--%s'%k, type=str, dest=k, default=d, help='Override the column header for %s. Default is "%s".' % (k,d))
     for k,d in Pedigree.RESERVED_KEYS.iteritems():
         parser.add_argument('--%s'%k, type=str, dest=k, default=d, help='Override the column header for %s. Default is "%s".' % (k,d))
+    for k,d in Pedigree.OPTIONAL_KEYS.iteritems():
+        parser.add_argument('--%s'%k, type=str, dest=k, default=d, help='Override the column header for %s. Default is "%s".' % (k,d))
     
     args = parser.parse_args()
+    args.trim = args.trim.strip().upper().startswith('T')
+    if args.trim and os.path.splitext(args.outfile.lower())[1] in ['.gexf','.json','.dot','.png']:
+        parser.error('--trim only works with ego-pa-ma output.')
     
     for k in Pedigree.REQUIRED_KEYS.keys():
         Pedigree.REQUIRED_KEYS[k] = getattr(args,k)
     for k in Pedigree.RESERVED_KEYS.keys():
         Pedigree.RESERVED_KEYS[k] = getattr(args,k)
+    for k in Pedigree.OPTIONAL_KEYS.keys():
+        Pedigree.OPTIONAL_KEYS[k] = getattr(args,k)
+    
+    phenotypes = Pedigree.REQUIRED_KEYS['affected']
+    Pedigree.REQUIRED_KEYS['affected'] = phenotypes[0]
+    
+    if args.checkpoint == None:
+        args.checkpoint = args.outfile + '.checkpoint'
     
     print "Loading file..."
-    ped = Pedigree(args.infile, countAndCalculate=True, zeroMissing=args.zeroMissing.strip().upper().startswith('T'), tickFunction=tick, numTicks = 100)
+    ped = Pedigree(args.infile, countAndCalculate=args.top <= 0, zeroMissing=args.zeroMissing.strip().upper().startswith('T'), tickFunction=tick, numTicks = 100, numProcesses=args.numProcesses, phenotypes=phenotypes,
+                   maxExactAffected=args.maxExactAffected, pairBudget=args.pairBudget, seed=args.seed,
+                   checkpointPath=args.checkpoint, checkpointInterval=args.checkpointInterval, resume=args.resume.strip().upper().startswith('T'),
+                   cachePath=args.cache, queuePath=args.queue, queueTimeout=args.queueTimeout, queueUnitSize=args.queueUnitSize)
+    if args.top > 0:
+        print "Ranking ancestors..."
+        ranked = ped.findTopAncestors(args.top, args.topBy)
+        with open(args.outfile,'wb') as outfile:
+            outfile.write('rank\t%s\t%s\t%s\t%s\n' % (Pedigree.REQUIRED_KEYS['personID'],Pedigree.RESERVED_KEYS['n_local_aff'],
+                                                      Pedigree.RESERVED_KEYS['n_local_desc'],Pedigree.RESERVED_KEYS['nicki_d']))
+            for rank,(p,numAffected,numDescendants,d) in enumerate(ranked):
+                outfile.write('%i\t%s\t%i\t%i\t%s\n' % (rank+1,p,numAffected,numDescendants,d))
+        print "Done."
+        sys.exit(0)
+    if args.permutations > 0:
+        print "Permuting..."
+        ped.calculatePermutationPValues(args.permutations, args.stratify.strip().upper().startswith('T'), args.seed)
+    if args.geneDrops > 0:
+        print "Dropping genes..."
+        ped.simulateGeneDrops(args.geneDrops, args.heritability, args.seed)
+    if args.enrichment.strip().upper().startswith('T'):
+        print "Scanning for enrichment..."
+        ped.calculateEnrichment(args.enrichmentStrata, args.enrichmentTest)
+    if args.kinship != None:
+        print "Calculating kinship..."
+        kinship = ped.calculateKinship()
+        with open(args.kinship,'wb') as outfile:
+            outfile.write('%s1\t%s2\tkinship\n' % (Pedigree.REQUIRED_KEYS['personID'],Pedigree.REQUIRED_KEYS['personID']))
+            for (a,b),phi in sorted(kinship.iteritems()):
+                outfile.write('%s\t%s\t%s\n' % (a,b,phi))
+    if args.gif != None:
+        print "Calculating GIF..."
+        summary = ped.calculateGIF(args.gifResamples, args.seed)
+        with open(args.gif,'wb') as outfile:
+            outfile.write('statistic\tvalue\n')
+            for k,v in summary.iteritems():
+                outfile.write('%s\t%s\n' % (k,v))
     print "Writing file..."
     lowPath = args.outfile.lower()
     if lowPath.endswith('.gexf'):
@@ -44,6 +145,9 @@ if __name__ == '__main__':
     elif lowPath.endswith('.png'):
         program = lowPath[:-4].split('.')[-1]
         ped.write_image(args.outfile, program)
+    elif args.trim:
+        ped.write_egopama(args.outfile, ped.getTrimmedSet())
     else:
         ped.write_egopama(args.outfile)
+    ped.removeCheckpoint()
     print "Done."
\ No newline at end of file
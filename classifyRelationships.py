@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import argparse, sys, itertools
+from resources.pedigree_data import Pedigree
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classifies how each pair of people in a list is related, given an ego-pa-ma file.')
+    parser.add_argument('--in', type=str, dest="infile", required = True, help='Path to ego-pa-ma tab-separated file with headers.')
+    parser.add_argument('--pairs', type=str, dest="pairs", default='-',
+                        help='Path to a file with two person IDs on each line (a header line is skipped); "-" reads from standard input. Default is "-".')
+    parser.add_argument('--out', type=str, dest="outfile", default='-',
+                        help='Path to write the relationships to as a tab-separated file; "-" writes to standard output. Default is "-".')
+    parser.add_argument('--chunkSize', type=int, dest="chunkSize", default=10000,
+                        help="Number of pairs to read and classify at a time. Default is 10000.")
+    parser.add_argument('--zeroMissingLines', type=str, dest="zeroMissing", required=False, nargs="?", default="False", const="True",
+                        help="If True, only lines in the file are used (and missing parents are replaced with zeros).")
+    
+    for k,d in Pedigree.REQUIRED_KEYS.iteritems():
+        parser.add_argument('--%s'%k, type=str, dest=k, default=d, help='Override the column header for %s. Default is "%s".' % (k,d))
+    
+    args = parser.parse_args()
+    
+    for k in Pedigree.REQUIRED_KEYS.keys():
+        Pedigree.REQUIRED_KEYS[k] = getattr(args,k)
+    
+    # Progress goes to stderr if the results are going to stdout
+    log = sys.stderr if args.outfile == '-' else sys.stdout
+    
+    log.write("Loading file...\n")
+    ped = Pedigree(args.infile, countAndCalculate=False, zeroMissing=args.zeroMissing.strip().upper().startswith('T'))
+    
+    def iterPairs(infile):
+        for line in infile:
+            columns = line.split()
+            if len(columns) < 2:
+                continue
+            try:
+                int(columns[0])
+            except ValueError:
+                continue
+            yield (columns[0],columns[1])
+    
+    log.write("Classifying pairs...\n")
+    infile = sys.stdin if args.pairs == '-' else open(args.pairs,'rb')
+    outfile = sys.stdout if args.outfile == '-' else open(args.outfile,'wb')
+    personID = Pedigree.REQUIRED_KEYS['personID']
+    outfile.write('%s1\t%s2\trelationship\tdegree\tmeioses1\tmeioses2\tcommon_ancestors\n' % (personID,personID))
+    pairs = iterPairs(infile)
+    numPairs = 0
+    while True:
+        chunk = list(itertools.islice(pairs, args.chunkSize))
+        if len(chunk) == 0:
+            break
+        for (p1,p2),result in itertools.izip(chunk, ped.classifyRelationships(chunk)):
+            if result == None:
+                sys.stderr.write('WARNING: Skipping %s and %s - not everyone is in the pedigree.\n' % (p1,p2))
+                outfile.write('%s\t%s\t\t\t\t\t\n' % (p1,p2))
+                continue
+            name,degree,meioses1,meioses2,closest = result
+            outfile.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (p1,p2,name,'' if degree == None else degree,
+                                                           '' if meioses1 == None else meioses1,
+                                                           '' if meioses2 == None else meioses2,','.join(closest)))
+        outfile.flush()
+        numPairs += len(chunk)
+        log.write("Classified %i pairs...\n" % numPairs)
+    if infile != sys.stdin:
+        infile.close()
+    if outfile != sys.stdout:
+        outfile.close()
+    log.write("Done.\n")
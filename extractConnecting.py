@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+import argparse
+from resources.pedigree_data import Pedigree
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the smallest piece of an ego-pa-ma file that connects a set of people through their most recent common ancestors.')
+    parser.add_argument('--in', type=str, dest="infile", required = True, help='Path to ego-pa-ma tab-separated file with headers.')
+    parser.add_argument('--out', type=str, dest="outfile", required = True, help='Path to write the connecting ego-pa-ma to (parents outside of it become 0s).')
+    parser.add_argument('--people', type=str, dest="people", default=[], nargs='+', help='IDs of the people to connect.')
+    parser.add_argument('--peopleFile', type=str, dest="peopleFile", default=None, help='Path to a file with more IDs to connect, one per line.')
+    parser.add_argument('--allAffected', type=str, dest="allAffected", required=False, nargs="?", default="False", const="True",
+                        help="If True, connect everyone who is affected (as well as anyone given with --people or --peopleFile).")
+    parser.add_argument('--withSpouses', type=str, dest="withSpouses", required=False, nargs="?", default="False", const="True",
+                        help="If True, also include the other parent of every child in the connecting pedigree.")
+    parser.add_argument('--zeroMissingLines', type=str, dest="zeroMissing", required=False, nargs="?", default="False", const="True",
+                        help="If True, only lines in the file are used (and missing parents are replaced with zeros).")
+    
+    for k,d in Pedigree.REQUIRED_KEYS.iteritems():
+        parser.add_argument('--%s'%k, type=str, dest=k, default=d, help='Override the column header for %s. Default is "%s".' % (k,d))
+    
+    args = parser.parse_args()
+    
+    for k in Pedigree.REQUIRED_KEYS.keys():
+        Pedigree.REQUIRED_KEYS[k] = getattr(args,k)
+    
+    print "Loading file..."
+    ped = Pedigree(args.infile, countAndCalculate=False, zeroMissing=args.zeroMissing.strip().upper().startswith('T'))
+    
+    people = set(args.people)
+    if args.peopleFile != None:
+        with open(args.peopleFile,'rb') as infile:
+            for line in infile:
+                if len(line.strip()) > 0:
+                    people.add(line.strip())
+    if args.allAffected.strip().upper().startswith('T'):
+        people.update(p for p in ped.rowOrder if ped.getAttribute(p, 'affected', None) == True)
+    if len(people) == 0:
+        parser.error('No people to connect - use --people, --peopleFile or --allAffected.')
+    
+    print "Connecting %i people..." % len(people)
+    connecting = ped.getConnectingSet(people, args.withSpouses.strip().upper().startswith('T'))
+    print "Writing %i people..." % len(connecting)
+    ped.write_egopama(args.outfile, connecting)
+    print "Done."
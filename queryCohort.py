@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import argparse, sys, os, itertools
+from resources.pedigree_data import Pedigree
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='For each proband in a list, extracts their ancestors (up to some number of generations) and those ancestors\' descendants from an ego-pa-ma file that only gets loaded once.')
+    parser.add_argument('--in', type=str, dest="infile", required = True, help='Path to ego-pa-ma tab-separated file with headers.')
+    parser.add_argument('--probands', type=str, dest="probands", default='-',
+                        help='Path to a file with a proband ID on each line (a header line is skipped); "-" reads from standard input. Default is "-".')
+    parser.add_argument('--up', type=float, dest="up", default=0,
+                        help='Number of generations of ancestors to include above each proband ("inf" for all of them). Default is 0.')
+    parser.add_argument('--down', type=float, dest="down", default=0,
+                        help='Number of generations of descendants to include below the proband and each of those ancestors ("inf" for all of them). Default is 0.')
+    parser.add_argument('--withSpouses', type=str, dest="withSpouses", required=False, nargs="?", default="False", const="True",
+                        help="If True, spouses are followed on the way down as well as children (each spouse counts as a generation, like iterDownWithSpouses).")
+    parser.add_argument('--out', type=str, dest="outfile", default=None,
+                        help='Path to write every cohort to as one long tab-separated file of proband / person pairs; "-" writes to standard output.')
+    parser.add_argument('--outDir', type=str, dest="outDir", default=None,
+                        help='Directory to write an ego-pa-ma file per proband to (named after the proband; parents outside of the cohort become 0s).')
+    parser.add_argument('--chunkSize', type=int, dest="chunkSize", default=10000,
+                        help="Number of probands to read and extract at a time. Default is 10000.")
+    parser.add_argument('--processes', type=int, dest="numProcesses", default=1,
+                        help="Number of processes to use; each chunk of probands is split between them by family. Default is 1.")
+    parser.add_argument('--zeroMissingLines', type=str, dest="zeroMissing", required=False, nargs="?", default="False", const="True",
+                        help="If True, only lines in the file are used (and missing parents are replaced with zeros).")
+    
+    for k,d in Pedigree.REQUIRED_KEYS.iteritems():
+        parser.add_argument('--%s'%k, type=str, dest=k, default=d, help='Override the column header for %s. Default is "%s".' % (k,d))
+    
+    args = parser.parse_args()
+    
+    if (args.outfile == None) == (args.outDir == None):
+        parser.error('Use exactly one of --out or --outDir.')
+    if args.up < 0 or args.down < 0:
+        parser.error('--up and --down can\'t be negative.')
+    
+    for k in Pedigree.REQUIRED_KEYS.keys():
+        Pedigree.REQUIRED_KEYS[k] = getattr(args,k)
+    
+    # Progress goes to stderr if the results are going to stdout
+    log = sys.stderr if args.outfile == '-' else sys.stdout
+    
+    log.write("Loading file...\n")
+    ped = Pedigree(args.infile, countAndCalculate=False, zeroMissing=args.zeroMissing.strip().upper().startswith('T'), numProcesses=args.numProcesses)
+    
+    def iterProbands(infile):
+        for line in infile:
+            columns = line.split()
+            if len(columns) < 1:
+                continue
+            try:
+                int(columns[0])
+            except ValueError:
+                continue
+            yield columns[0]
+    
+    log.write("Extracting cohorts...\n")
+    infile = sys.stdin if args.probands == '-' else open(args.probands,'rb')
+    outfile = None
+    if args.outfile != None:
+        outfile = sys.stdout if args.outfile == '-' else open(args.outfile,'wb')
+        outfile.write('proband\t%s\n' % Pedigree.REQUIRED_KEYS['personID'])
+    elif not os.path.isdir(args.outDir):
+        os.makedirs(args.outDir)
+    withSpouses = args.withSpouses.strip().upper().startswith('T')
+    probands = iterProbands(infile)
+    numProbands = 0
+    while True:
+        chunk = list(itertools.islice(probands, args.chunkSize))
+        if len(chunk) == 0:
+            break
+        for proband,cohort in itertools.izip(chunk, ped.getCohorts(chunk, args.up, args.down, withSpouses)):
+            if cohort == None:
+                sys.stderr.write('WARNING: Skipping %s - not in the pedigree.\n' % proband)
+                continue
+            if outfile != None:
+                for p in cohort:
+                    outfile.write('%s\t%s\n' % (proband,p))
+            else:
+                ped.write_egopama(os.path.join(args.outDir,'%s.txt' % proband), cohort)
+        if outfile != None:
+            outfile.flush()
+        numProbands += len(chunk)
+        log.write("Extracted %i cohorts...\n" % numProbands)
+    if infile != sys.stdin:
+        infile.close()
+    if outfile != None and outfile != sys.stdout:
+        outfile.close()
+    log.write("Done.\n")
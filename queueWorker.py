@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+import argparse, multiprocessing
+from resources.work_queue import WorkQueue
+
+def work(args):
+    path,wait = args
+    return WorkQueue(path).work(wait)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Works on the units that calculateD.py --queue hands out, until it says the job is finished. Start as many of these as you like, on any host that can see the queue directory.')
+    parser.add_argument('--queue', type=str, dest="queue", required = True, help='Path to the work queue directory given to calculateD.py --queue.')
+    parser.add_argument('--processes', type=int, dest="numProcesses", default=1,
+                        help="Number of units to work on at once. Default is 1.")
+    parser.add_argument('--wait', type=int, dest="wait", default=5,
+                        help="Seconds to wait between looking for new units when there aren't any. Default is 5.")
+    
+    args = parser.parse_args()
+    
+    print "Waiting for work..."
+    if args.numProcesses > 1:
+        pool = multiprocessing.Pool(args.numProcesses)
+        numDone = sum(pool.map(work, [(args.queue,args.wait)]*args.numProcesses))
+        pool.close()
+        pool.join()
+    else:
+        numDone = work((args.queue,args.wait))
+    print "Done (%i units)." % numDone
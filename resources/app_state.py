@@ -2,7 +2,7 @@ import math, networkx
 from colormath.color_objects import LabColor, RGBColor
 from PySide.QtGui import QColor, QMenu, QCursor
 from PySide.QtCore import Qt
-from pedigree_data import AttributeFilter
+from pedigree_data import AttributeFilter, TraversalCache
 
 class AppComponent(object):
     def notifyHighlightAnIndividual(self, previous, new):
@@ -27,6 +27,8 @@ class AppComponent(object):
         pass
     def notifyChangePreferences(self, previous, new):
         pass
+    def notifySortBy(self, attribute, descending):
+        pass
 
 class AppPreferences(object):
     def __init__(self):
@@ -116,11 +118,13 @@ class AppState(object):
         
         self.components = set()
         
-        self.additionIterators = {'Direct Ancestors':self.ped.iterUp,
-                                  'Direct Descendants':self.ped.iterDown,
-                                  'Ascend':self.ped.iterUpWithSpouses,
-                                  'Descend':self.ped.iterDownWithSpouses,
-                                  'All Directions':self.ped.iterFrom}
+        # People tend to expand from the same few individuals over and over
+        self.traversals = TraversalCache(self.ped)
+        self.additionIterators = {'Direct Ancestors':self.traversals.iterUp,
+                                  'Direct Descendants':self.traversals.iterDown,
+                                  'Ascend':self.traversals.iterUpWithSpouses,
+                                  'Descend':self.traversals.iterDownWithSpouses,
+                                  'All Directions':self.traversals.iterFrom}
     
     def registerComponent(self, c):
         self.components.add(c)
@@ -269,11 +273,31 @@ class AppState(object):
             parentHistoryID = self.aHistoryID
         elif person in self.bSet:
             parentHistoryID = self.bHistoryID
-        peopleToDiscard = set(self.ped.iterFrom(person,directions,level=1,skipFirst=True))
+        peopleToDiscard = set(self.traversals.iterFrom(person,directions,level=1,skipFirst=True))
         newSet = self.getHistoryPeople(parentHistoryID).difference(peopleToDiscard)
         newSet = self.ped.getConnectedComponent(person,newSet)
         self.addPedigree(newSet,[parentHistoryID])
     
+    def trimUninformative(self, person):
+        # Trims whichever set the person is in (see Pedigree.getTrimmedSet)
+        parentHistoryID = None
+        if person in self.abIntersection:
+            self.performUnion()
+            parentHistoryID = self.aHistoryID
+        elif person in self.aSet:
+            parentHistoryID = self.aHistoryID
+        elif person in self.bSet:
+            parentHistoryID = self.bHistoryID
+        newSet = self.ped.getTrimmedSet(self.getHistoryPeople(parentHistoryID))
+        self.addPedigree(newSet,[parentHistoryID])
+    
+    def connect(self, people, parentIDs=None):
+        # Loads the smallest pedigree connecting people (and the other parents of its children)
+        # straight into set A
+        newSet = self.ped.getConnectingSet(people, withSpouses=True)
+        historyID = self.addPedigree(newSet, parentIDs)
+        self.changePedigreeA(historyID)
+    
     def addPedigree(self, newPeopleSet, parentIDs=None):
         newID = self.historyCounter
         self.historyCounter += 1
@@ -349,6 +373,10 @@ class AppState(object):
     def changeFilter(self):
         pass    # TODO
     
+    def sortBy(self, attribute, descending=False):
+        for c in self.components:
+            c.notifySortBy(attribute, descending)
+    
     def showScatterplot(self, attr1, attr2):
         prev1 = self.scatterX
         prev2 = self.scatterY
@@ -399,10 +427,19 @@ class AppState(object):
         actionLookup['Trim Parents'] = m.addAction('Trim Parents')
         actionLookup['Trim Spouses'] = m.addAction('Trim Spouses')
         actionLookup['Trim Children'] = m.addAction('Trim Children')
+        actionLookup['Trim Uninformative'] = m.addAction('Trim Uninformative')
         if not person in self.aSet and not person in self.bSet:
             actionLookup['Trim Parents'].setDisabled(True)
             actionLookup['Trim Spouses'].setDisabled(True)
             actionLookup['Trim Children'].setDisabled(True)
+            actionLookup['Trim Uninformative'].setDisabled(True)
+        
+        m.addSeparator()
+        
+        aAffected = set(p for p in self.aSet if self.ped.getAttribute(p, 'affected', None) == True)
+        actionLookup['Connect Affecteds in A'] = m.addAction('Connect Affecteds in A')
+        if len(aAffected) < 2:
+            actionLookup['Connect Affecteds in A'].setDisabled(True)
         
         m.addSeparator()
         
@@ -427,6 +464,10 @@ class AppState(object):
                                            self.ped.WIFE_TO_HUSBAND])
                     elif menus == 'Trim Children':
                         self.snip(person, [self.ped.PARENT_TO_CHILD])
+                    elif menus == 'Trim Uninformative':
+                        self.trimUninformative(person)
+                    elif menus == 'Connect Affecteds in A':
+                        self.connect(aAffected, [self.aHistoryID])
                     else:
                         assert isinstance(menus,tuple)
                         newSet = set(menus[1](person,level=menus[2]))
@@ -449,16 +490,18 @@ class AppState(object):
         c = m.addMenu('Compare to')
         for h in self.headers:
             c.addAction(h)
-        m.addAction('Sort...')
+        m.addAction('Sort Ascending')
+        m.addAction('Sort Descending')
         choice = m.exec_(QCursor.pos())
         
         if choice != None:
             choice = choice.text()
             if choice == 'Overlay/Filter':
                 self.changeOverlay(attribute)
-            elif choice == 'Sort...':
-                # TODO
-                pass
+            elif choice == 'Sort Ascending':
+                self.sortBy(attribute)
+            elif choice == 'Sort Descending':
+                self.sortBy(attribute, descending=True)
             else:
                 self.showScatterplot(choice,attribute)
     
@@ -0,0 +1,129 @@
+'''
+Array versions of the tightest traversal loops in pedigree_data, for big families: compiled with
+numba if it's installed, or as vectorized numpy (one step per BFS level) if it isn't. Both give
+exactly the same answers as the pure Python versions, which are still what runs without numpy, and
+for families under pedigree_data.KERNEL_FAMILY_SIZE people, where the arrays don't pay for
+themselves
+'''
+import itertools, math, array, numpy
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def linkArrays(links):
+    # Per-person link lists (like a family's parents or children) as CSR arrays
+    starts = numpy.zeros(len(links)+1, dtype=numpy.int64)
+    starts[1:] = numpy.cumsum([len(l) for l in links])
+    indices = numpy.fromiter(itertools.chain.from_iterable(links), dtype=numpy.int32, count=starts[-1])
+    return starts,indices
+
+def _bfsLoop(starts, indices, source, level, isTarget, numTargets, distances, order):
+    '''
+    BFS from source over CSR links, out to level steps or until numTargets people with isTarget
+    set have been found (never, if numTargets is negative). distances has to be -1 for everyone
+    beforehand; it gets filled in for everyone reached, and order gets the order they were reached
+    in. Returns how many people were reached. This is the version that numba compiles
+    '''
+    distances[source] = 0
+    order[0] = source
+    head = 0
+    tail = 1
+    remaining = numTargets
+    if isTarget[source]:
+        remaining -= 1
+    while head < tail and remaining != 0:
+        p = order[head]
+        head += 1
+        if distances[p] >= level:
+            continue
+        for x in range(starts[p],starts[p+1]):
+            q = indices[x]
+            if distances[q] < 0:
+                distances[q] = distances[p]+1
+                order[tail] = q
+                tail += 1
+                if isTarget[q]:
+                    remaining -= 1
+    return tail
+
+def _bfsLevels(starts, indices, source, level, isTarget, numTargets, distances, order):
+    # Same as _bfsLoop, a whole level at a time with numpy; people within a level come out in the
+    # order they were first reached, like they would from a queue
+    distances[source] = 0
+    order[0] = source
+    frontier = order[0:1]
+    tail = 1
+    remaining = numTargets - (1 if isTarget[source] else 0)
+    l = 0
+    while len(frontier) > 0 and l < level and remaining != 0:
+        counts = starts[frontier+1]-starts[frontier]
+        offsets = numpy.repeat(starts[frontier]-(numpy.cumsum(counts)-counts), counts) + numpy.arange(counts.sum())
+        neighbors = indices[offsets]
+        neighbors = neighbors[distances[neighbors] < 0]
+        neighbors,first = numpy.unique(neighbors, return_index=True)
+        l += 1
+        distances[neighbors] = l
+        remaining -= numpy.count_nonzero(isTarget[neighbors])
+        order[tail:tail+len(neighbors)] = neighbors[numpy.argsort(first, kind='mergesort')]
+        frontier = order[tail:tail+len(neighbors)]
+        tail += len(neighbors)
+    return tail
+
+LAYERS = {'numpy':_bfsLevels}
+if numba != None:
+    LAYERS['numba'] = numba.njit(nogil=True)(_bfsLoop)
+LAYER = 'numba' if numba != None else 'numpy'
+
+class _Workspace(object):
+    # CSR links, plus distances and order arrays that get reused from one BFS to the next (only
+    # the people a BFS reached get reset), so that a short traversal in a big family stays cheap
+    def __init__(self, links, layer):
+        self.bfs = LAYERS[layer or LAYER]
+        self.starts,self.indices = linkArrays(links)
+        self.distances = numpy.full(len(links), -1, dtype=numpy.int32)
+        self.order = numpy.empty(len(links), dtype=numpy.int32)
+    
+    def run(self, source, level, isTarget, numTargets):
+        # Returns everyone reached, in order; self.distances holds their distances until reset()
+        return self.order[:self.bfs(self.starts, self.indices, source, level, isTarget, numTargets, self.distances, self.order)]
+    
+    def reset(self, reached):
+        self.distances[reached] = -1
+
+def familyDistanceFunction(parents, children, targets, layer=None):
+    # Returns a function that does familyDistances(parents, children, source, targets) for any source
+    workspace = _Workspace([tuple(ps)+tuple(cs) for ps,cs in itertools.izip(parents, children)], layer)
+    targetList = numpy.array(sorted(targets), dtype=numpy.int32)
+    isTarget = numpy.zeros(len(parents), dtype=numpy.bool_)
+    isTarget[targetList] = True
+    def distancesFrom(source):
+        reached = workspace.run(source, len(parents), isTarget, len(targetList))
+        distances = workspace.distances[targetList].tolist()
+        workspace.reset(reached)
+        return dict((t,d) for t,d in itertools.izip(targetList.tolist(), distances) if d >= 0)
+    return distancesFrom
+
+def familyDistanceRowFunction(parents, children, targets, layer=None):
+    # Returns a function that gives the distances from any source to every target, in sorted
+    # order, as an array of C ints (-1 for targets it isn't connected to)
+    workspace = _Workspace([tuple(ps)+tuple(cs) for ps,cs in itertools.izip(parents, children)], layer)
+    targetList = numpy.array(sorted(targets), dtype=numpy.int32)
+    isTarget = numpy.zeros(len(parents), dtype=numpy.bool_)
+    isTarget[targetList] = True
+    def rowFrom(source):
+        reached = workspace.run(source, len(parents), isTarget, len(targetList))
+        row = array.array('i', workspace.distances[targetList].astype(numpy.intc).tostring())
+        workspace.reset(reached)
+        return row
+    return rowFrom
+
+def familyWithinFunction(links, layer=None):
+    # Returns a function that does familyWithin(links, person, level) for any person and level
+    workspace = _Workspace(links, layer)
+    isTarget = numpy.zeros(len(links), dtype=numpy.bool_)
+    def within(person, level):
+        reached = workspace.run(person, len(links) if math.isinf(level) else int(level), isTarget, -1)
+        workspace.reset(reached)
+        return reached.tolist()
+    return within
@@ -1,4 +1,6 @@
-import networkx, sys, math
+import networkx, sys, os, math, time, itertools, multiprocessing, random, gzip, cPickle, hashlib, bisect, heapq, array
+from collections import deque, OrderedDict
+from work_queue import WorkQueue
 
 class AttributeFilter(object):
     def __init__(self, details, notifier):
@@ -77,6 +79,835 @@ class AttributeDetails(object):
         except ValueError:
             self._getClass(f)
 
+def familyChildren(parents):
+    children = [[] for i in xrange(len(parents))]
+    for i,ps in enumerate(parents):
+        for j in ps:
+            children[j].append(i)
+    return children
+
+def familyDescendants(children, person):
+    # BFS down a family's child lists; the person counts as one of their own descendants
+    visited = set([person])
+    toVisit = deque([person])
+    while len(toVisit) > 0:
+        p = toVisit.popleft()
+        for c in children[p]:
+            if not c in visited:
+                visited.add(c)
+                toVisit.append(c)
+    return visited
+
+def familyTopologicalOrder(parents, children):
+    # Parents before children, and whether that worked out for everyone: people caught in a loop
+    # of their own ancestry (a data error) never come free, so they go on the end in member order
+    numParents = [len(ps) for ps in parents]
+    order = [i for i,n in enumerate(numParents) if n == 0]
+    x = 0
+    while x < len(order):
+        for c in children[order[x]]:
+            numParents[c] -= 1
+            if numParents[c] == 0:
+                order.append(c)
+        x += 1
+    acyclic = len(order) == len(parents)
+    if not acyclic:
+        ordered = set(order)
+        order.extend(i for i in xrange(len(parents)) if not i in ordered)
+    return order,acyclic
+
+def familyAncestryIndex(parents, children):
+    '''
+    Interval labels for "is a an ancestor of b" questions within a family. Everyone gets a
+    postorder number from a DFS down child links; within one DFS tree a person's descendants have
+    contiguous numbers, but a child only hangs off one of their parents in the tree (and
+    cousin marriages join branches back up), so each person is labelled with the merged list of
+    intervals that covers everyone below them - in practice only a few. Returns (postorder
+    numbers, interval starts, interval ends) for familyIsAncestor
+    '''
+    order,acyclic = familyTopologicalOrder(parents, children)
+    post = [None]*len(parents)
+    low = [None]*len(parents)
+    counter = 0
+    for root in order:
+        if post[root] != None or low[root] != None:
+            continue
+        low[root] = counter
+        stack = [(root,iter(children[root]))]
+        while len(stack) > 0:
+            p,remaining = stack[-1]
+            for c in remaining:
+                if low[c] == None:
+                    low[c] = counter
+                    stack.append((c,iter(children[c])))
+                    break
+            else:
+                stack.pop()
+                post[p] = counter
+                counter += 1
+    
+    starts = [None]*len(parents)
+    ends = [None]*len(parents)
+    for i in reversed(order):
+        if acyclic:
+            spans = [(low[i],post[i])]
+            for c in children[i]:
+                spans.extend(itertools.izip(starts[c],ends[c]))
+        else:
+            # Children aren't guaranteed to be labelled first if there's a loop
+            spans = [(post[p],post[p]) for p in familyDescendants(children, i)]
+        spans.sort()
+        starts[i] = []
+        ends[i] = []
+        for s,e in spans:
+            if len(ends[i]) > 0 and s <= ends[i][-1]+1:
+                ends[i][-1] = max(ends[i][-1],e)
+            else:
+                starts[i].append(s)
+                ends[i].append(e)
+    return (post,starts,ends)
+
+def familyIsAncestor(index, a, b):
+    # True if a is b's ancestor, or b themselves
+    post,starts,ends = index
+    x = bisect.bisect_right(starts[a], post[b])-1
+    return x >= 0 and post[b] <= ends[a][x]
+
+def maskMembers(mask):
+    # Indices of the set bits in a family bitmask
+    members = []
+    while mask:
+        low = mask & -mask
+        members.append(low.bit_length()-1)
+        mask ^= low
+    return members
+
+class FamilyStatistic(object):
+    '''
+    A per-person statistic that only needs a person's own attributes, plus the values it already
+    has for their children (BOTTOM_UP) or their parents (TOP_DOWN). Every statistic is worked out
+    in the same two passes over each family - parents first for TOP_DOWN, children first for
+    BOTTOM_UP - so adding one doesn't cost another sweep over the whole graph. Subclasses need to
+    override calculate(person, attributes, relativeValues), where person is an index into the
+    family, attributes are the person's values for self.attributes, and relativeValues are what
+    calculate gave their children (or parents); it returns the value to pass on. Subclasses also
+    need to live at module level so that they can be sent to worker processes
+    '''
+    BOTTOM_UP = 0
+    TOP_DOWN = 1
+    
+    def __init__(self, key, direction=BOTTOM_UP, attributes=None):
+        self.key = key
+        self.direction = direction
+        self.attributes = attributes if attributes != None else []
+    
+    def finish(self, value):
+        # Turns the value that gets passed between relatives into the one that gets stored
+        return value
+
+class IsRootStatistic(FamilyStatistic):
+    def __init__(self):
+        FamilyStatistic.__init__(self, 'is_root', FamilyStatistic.TOP_DOWN)
+    
+    def calculate(self, person, attributes, relativeValues):
+        return len(relativeValues) == 0
+
+class IsLeafStatistic(FamilyStatistic):
+    def __init__(self):
+        FamilyStatistic.__init__(self, 'is_leaf', FamilyStatistic.BOTTOM_UP)
+    
+    def calculate(self, person, attributes, relativeValues):
+        return len(relativeValues) == 0
+
+def runFamilyStatistics(parents, children, attributes, statistics):
+    '''
+    Runs every statistic over a family in one parents-first pass and one children-first pass.
+    attributes[i][s] holds person i's values for statistics[s].attributes. A person's passed-on
+    values are only kept until every relative that needs them has had them. Returns the finished
+    values, statistic by statistic, and whether the family was free of ancestry loops (if it
+    wasn't, relatives in a loop that haven't been visited yet show up as None)
+    '''
+    order,acyclic = familyTopologicalOrder(parents, children)
+    values = [[None]*len(parents) for statistic in statistics]
+    for direction,people,relatives,users in [(FamilyStatistic.TOP_DOWN,order,parents,children),
+                                             (FamilyStatistic.BOTTOM_UP,reversed(order),children,parents)]:
+        passStatistics = [(s,statistic) for s,statistic in enumerate(statistics) if statistic.direction == direction]
+        if len(passStatistics) == 0:
+            continue
+        # Person -> [unfinished values, number of relatives still to use them]
+        pending = {}
+        for i in people:
+            relativeValues = [pending[r][0] if pending.has_key(r) else None for r in relatives[i]]
+            passed = []
+            for x,(s,statistic) in enumerate(passStatistics):
+                v = statistic.calculate(i, attributes[i][s], [rv[x] if rv != None else None for rv in relativeValues])
+                values[s][i] = statistic.finish(v)
+                passed.append(v)
+            if len(users[i]) > 0:
+                pending[i] = [passed,len(users[i])]
+            for r in relatives[i]:
+                if pending.has_key(r):
+                    pending[r][1] -= 1
+                    if pending[r][1] == 0:
+                        del pending[r]
+    return values,acyclic
+
+def familyDistances(parents, children, source, targets):
+    # BFS over parent / child links (so the distance is the number of meioses), stopping as soon
+    # as every target has been found
+    found = {source:0}
+    remaining = len(targets) - (1 if source in targets else 0)
+    toVisit = deque([source])
+    while len(toVisit) > 0 and remaining > 0:
+        p = toVisit.popleft()
+        for p2 in itertools.chain(parents[p],children[p]):
+            if not found.has_key(p2):
+                found[p2] = found[p]+1
+                toVisit.append(p2)
+                if p2 in targets:
+                    remaining -= 1
+    return dict((p,l) for p,l in found.iteritems() if p in targets)
+
+# Families at least this big get traversed with the array kernels in kernels.py, if numpy is around
+KERNEL_FAMILY_SIZE = 1000
+
+def loadKernels(familySize):
+    # The kernels module, or None if the family's too small for it or there's no numpy
+    if familySize < KERNEL_FAMILY_SIZE:
+        return None
+    try:
+        import kernels
+    except ImportError:
+        return None
+    return kernels
+
+def familyDistanceFunction(parents, children, targets):
+    # familyDistances from one source after another
+    kernels = loadKernels(len(parents))
+    if kernels != None:
+        return kernels.familyDistanceFunction(parents, children, targets)
+    return lambda source: familyDistances(parents, children, source, targets)
+
+def familyDistanceRowFunction(parents, children, targets):
+    # Distances from one source after another to every target (in sorted order), as an array of
+    # ints with -1 for targets the source isn't connected to
+    kernels = loadKernels(len(parents))
+    if kernels != None:
+        return kernels.familyDistanceRowFunction(parents, children, targets)
+    order = sorted(targets)
+    def rowFrom(source):
+        found = familyDistances(parents, children, source, targets)
+        return array.array('i', [found.get(t,-1) for t in order])
+    return rowFrom
+
+# Most meioses (one int each) that a family's distance rows may hold at once
+MAX_CACHED_MEIOSES = 1 << 24
+
+def familyMeiosesRows(parents, children, targets):
+    '''
+    Distance rows between the targets, built on demand: returns (rank, row), where rank maps each
+    target to its place in sorted(targets) and row(a) is an array of the meioses from a to every
+    target in that order (-1 if they aren't connected). Only the most recently used rows are kept,
+    as many as fit in MAX_CACHED_MEIOSES, so memory doesn't grow with the square of the number of
+    targets
+    '''
+    rowFrom = familyDistanceRowFunction(parents, children, targets)
+    rank = dict((t,r) for r,t in enumerate(sorted(targets)))
+    maxRows = max(2, MAX_CACHED_MEIOSES/max(1,len(rank)))
+    rows = OrderedDict()
+    def row(a):
+        if rows.has_key(a):
+            # Move it to the back so that it gets evicted last
+            distances = rows.pop(a)
+        else:
+            distances = rowFrom(a)
+            if len(rows) >= maxRows:
+                rows.popitem(last=False)
+        rows[a] = distances
+        return distances
+    return rank,row
+
+def familyMeiosesFunction(parents, children, targets):
+    # meioses(a,b) between any two of the targets, from familyMeiosesRows
+    rank,row = familyMeiosesRows(parents, children, targets)
+    last = [None,None]
+    def meioses(a, b):
+        if last[0] != a:
+            last[0] = a
+            last[1] = row(a)
+        return last[1][rank[b]]
+    return meioses
+
+def writeCheckpoint(path, state):
+    # Write to a temporary file first so that getting killed mid-write doesn't clobber the last
+    # good checkpoint
+    tempPath = path + '.tmp'
+    with gzip.open(tempPath,'wb') as outfile:
+        cPickle.dump(state, outfile, cPickle.HIGHEST_PROTOCOL)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tempPath, path)
+
+def readCheckpoint(path):
+    with gzip.open(path,'rb') as infile:
+        return cPickle.load(infile)
+
+def familySpouses(parents, children, person):
+    # Everyone the person had children with (including themselves) could be an extra common
+    # ancestor of the person's descendants
+    spouses = set()
+    for c in children[person]:
+        spouses.update(parents[c])
+    return spouses
+
+def familySpouseSets(ancestry, spouses, p_aff):
+    # Which of the affecteds each of those spouses is also an ancestor of
+    return [set(a for a in p_aff if familyIsAncestor(ancestry, s, a)) for s in spouses]
+
+def familyPairTerm(meioses, a, b, spouseSets):
+    # One pair's contribution to d; meioses(a,b) is the shortest path between them
+    commonAncestors = 1.0
+    for s in spouseSets:
+        if a in s and b in s:
+            commonAncestors += 1.0
+    return -math.log(commonAncestors*0.5**(meioses(a,b)+1))*Pedigree.INV_LOG_TWO
+
+def familyExactD(meioses, p_aff, spouseSets):
+    # d over every pair of affecteds, in p_aff's order
+    d = 0.0
+    for x,a in enumerate(p_aff):
+        for b in p_aff[x+1:]:
+            d += familyPairTerm(meioses, a, b, spouseSets)
+    return d/(len(p_aff)-1)
+
+def _calculateFamily(task):
+    '''
+    Runs the family statistics (see runFamilyStatistics), counts descendants and affected
+    descendants and calculates d for a single connected family. This needs to be a module-level
+    function so that it can be handed to a multiprocessing pool; everything it needs comes in the
+    task tuple, with people referred to by their index in memberIDs. Affected statuses are
+    bitmasks, with one bit per phenotype, so that all the phenotypes can share one traversal of
+    each person's descendants (only one person's are held at a time). If
+    approximation is (maxExactAffected, pairBudget, seed), d is estimated from a sample of pairs
+    for anyone with more than maxExactAffected affected descendants. If checkpoint is (path,
+    interval, resume, signature), the d values finished so far get written to path every interval
+    seconds (and on Ctrl-C), and picked back up if resuming from a checkpoint with the same
+    signature (see Pedigree._getCheckpointSignature). ancestry is the family's familyAncestryIndex,
+    which the Pedigree already has. If span is (start, stop), d is only calculated for the people
+    in that range, and the statistics and counts are only worked out (and come back) with the
+    first span (see Pedigree._queueFamilies)
+    '''
+    familyIndex, memberIDs, parents, affected, numPhenotypes, approximation, checkpoint, statistics, attributes, ancestry, span = task
+    
+    children = familyChildren(parents)
+    
+    # Descendants come from one traversal per person (the person first, then everyone below them)
+    descendantsOf = familyWithinFunction(children)
+    def affectedBelow(i):
+        # The person's affected descendants, for each phenotype
+        below = [[] for j in xrange(numPhenotypes)]
+        for p in descendantsOf(i, float('inf')):
+            if affected[p]:
+                for j in xrange(numPhenotypes):
+                    if affected[p] & (1 << j):
+                        below[j].append(p)
+        return below
+    
+    statisticValues = nLocalAff = None
+    if span == None or span[0] == 0:
+        values,acyclic = runFamilyStatistics(parents, children, attributes, statistics)
+        statisticValues = {}
+        for s,statistic in enumerate(statistics):
+            statisticValues[statistic.key] = values[s]
+        statisticValues['inbreeding'] = familyInbreeding(parents, children) or [None]*len(memberIDs)
+        
+        numDescendants = []
+        nLocalAff = [[] for j in xrange(numPhenotypes)]
+        for i in xrange(len(memberIDs)):
+            below = descendantsOf(i, float('inf'))
+            numDescendants.append(len(below))
+            counts = [0]*numPhenotypes
+            for p in below:
+                if affected[p]:
+                    for j in xrange(numPhenotypes):
+                        if affected[p] & (1 << j):
+                            counts[j] += 1
+            for j in xrange(numPhenotypes):
+                nLocalAff[j].append(counts[j])
+        statisticValues['n_local_desc'] = numDescendants
+    
+    # Meioses are the shortest path between two affecteds over parent / child links; we do one
+    # BFS per affected and only hang on to the distances to other affecteds (of any phenotype),
+    # for as many affecteds as fit in MAX_CACHED_MEIOSES
+    allAffected = set(i for i,mask in enumerate(affected) if mask)
+    meioses = familyMeiosesFunction(parents, children, allAffected)
+    
+    def approximateD(p_aff, spouseSets):
+        # Sample whole rows of the pair matrix (every pair for a random subset of affecteds) so
+        # that each BFS pays for itself; the sum over all pairs is k/2 times the mean row sum
+        k = len(p_aff)
+        numRows = min(k,max(2,int(math.ceil(float(pairBudget)/(k-1)))))
+        rowSums = []
+        for a in generator.sample(p_aff, numRows):
+            rowSums.append(sum(familyPairTerm(meioses, a, b, spouseSets) for b in p_aff if b != a))
+        mean = sum(rowSums)/numRows
+        variance = sum((r-mean)**2 for r in rowSums)/(numRows-1)
+        scale = k/2.0/(k-1)
+        stdError = scale*math.sqrt(variance/numRows*(1.0-float(numRows)/k))
+        # 95% confidence interval
+        return (mean*scale, mean*scale-1.96*stdError, mean*scale+1.96*stdError)
+    
+    if approximation != None:
+        maxExactAffected,pairBudget,seed = approximation
+        generator = random.Random((seed << 32) + familyIndex)
+    
+    nickiD = [[] for j in xrange(numPhenotypes)]
+    intervals = [[] for j in xrange(numPhenotypes)]
+    start = 0
+    if checkpoint != None:
+        checkpointPath,checkpointInterval,resume,signature = checkpoint
+        if resume and os.path.exists(checkpointPath):
+            state = readCheckpoint(checkpointPath)
+            if state[0] != signature:
+                sys.stderr.write('WARNING: %s was made from a different file or with different settings - starting this family from scratch.\n' % checkpointPath)
+            else:
+                start,nickiD,intervals,generatorState = state[1:]
+                if approximation != None:
+                    generator.setstate(generatorState)
+        lastCheckpoint = time.time()
+    
+    def saveProgress(i):
+        writeCheckpoint(checkpointPath, (signature,
+                                         i,
+                                         [l[:i] for l in nickiD],
+                                         [l[:i] for l in intervals],
+                                         generator.getstate() if approximation != None else None))
+    
+    stop = len(memberIDs)
+    if span != None:
+        start,stop = span
+    
+    i = start
+    try:
+        for i in xrange(start,stop):
+            if checkpoint != None and time.time() - lastCheckpoint > checkpointInterval:
+                saveProgress(i)
+                lastCheckpoint = time.time()
+            if nLocalAff != None and all(nLocalAff[j][i] <= 1 for j in xrange(numPhenotypes)):
+                for j in xrange(numPhenotypes):
+                    nickiD[j].append(None)
+                    intervals[j].append(None)
+                continue
+            spouses = familySpouses(parents, children, i)
+            below = affectedBelow(i)
+            for j in xrange(numPhenotypes):
+                # We need a consistent ordering of affecteds to calculate d
+                p_aff = sorted(below[j], key=memberIDs.__getitem__)
+                if len(p_aff) <= 1:
+                    nickiD[j].append(None)
+                    intervals[j].append(None)
+                    continue
+                spouseSets = familySpouseSets(ancestry, spouses, p_aff)
+                if approximation != None and len(p_aff) > maxExactAffected:
+                    d,low,high = approximateD(p_aff, spouseSets)
+                    nickiD[j].append(d)
+                    intervals[j].append((low,high))
+                else:
+                    nickiD[j].append(familyExactD(meioses, p_aff, spouseSets))
+                    intervals[j].append(None)
+    except KeyboardInterrupt:
+        if checkpoint != None and i > start:
+            saveProgress(i)
+        raise
+    
+    return (familyIndex, statisticValues, nLocalAff, nickiD, intervals)
+
+def _calculateUnit(unit):
+    # A batch of _calculateFamily tasks, so that small families can share a work unit; contents
+    # (what the coordinator says is in the unit) come back with the results, for it to check
+    contents,tasks = unit
+    return (contents,[_calculateFamily(task) for task in tasks])
+
+def familyKinship(parents, position, pairs, kinship=None):
+    '''
+    Kinship coefficients for the given pairs of family members, straight from the recursive
+    definition: if a comes after b in generation (topological) order, a can't be b's ancestor,
+    so phi(a,b) = (phi(father,b) + phi(mother,b))/2, and phi(a,a) = (1 + phi(father,mother))/2.
+    Unknown parents count as unrelated. Only the pairs that the requested ones lead back to get
+    worked out (and kept in kinship, keyed with the later person first)
+    '''
+    if kinship == None:
+        kinship = {}
+    
+    def ordered(a, b):
+        return (a,b) if position[a] >= position[b] else (b,a)
+    
+    results = []
+    for pair in pairs:
+        pair = ordered(*pair)
+        toVisit = [pair]
+        while len(toVisit) > 0:
+            a,b = toVisit[-1]
+            if kinship.has_key((a,b)):
+                toVisit.pop()
+                continue
+            if a == b:
+                needs = [ordered(*parents[a])] if len(parents[a]) == 2 else []
+            else:
+                needs = [ordered(p,b) for p in parents[a]]
+            missing = [n for n in needs if not kinship.has_key(n)]
+            if len(missing) > 0:
+                toVisit.extend(missing)
+                continue
+            if a == b:
+                kinship[(a,b)] = 0.5*(1.0 + sum(kinship[n] for n in needs))
+            else:
+                kinship[(a,b)] = 0.5*sum(kinship[n] for n in needs)
+            toVisit.pop()
+        results.append(kinship[pair])
+    return results
+
+def familyInbreeding(parents, children):
+    '''
+    Inbreeding coefficients for everyone in a family with Meuwissen & Luo's (1992) method, which
+    only needs linear memory: people are numbered in generation order (so parents come first),
+    and for each person we push their contributions back through a linked list of ancestors kept
+    in descending order, adding up L^2*D along the way (D being each ancestor's within-family
+    variance). Children of the same couple share a coefficient, so each couple only gets traced
+    once. Returns None if the family has an ancestry loop
+    '''
+    order,acyclic = familyTopologicalOrder(parents, children)
+    if not acyclic:
+        return None
+    # Numbers start at 1; 0 is an unknown parent, with an inbreeding coefficient of -1
+    numbers = [None]*len(parents)
+    for x,i in enumerate(order):
+        numbers[i] = x+1
+    numbered = [()]+[tuple(sorted((numbers[p] for p in parents[i]), reverse=True)) for i in order]
+    
+    F = [0.0]*(len(order)+1)
+    F[0] = -1.0
+    D = [0.0]*(len(order)+1)
+    L = [0.0]*(len(order)+1)
+    point = [0]*(len(order)+1)
+    couples = {}
+    for i in xrange(1,len(order)+1):
+        ps = numbered[i]
+        D[i] = 0.5-0.25*(F[ps[0]] if len(ps) > 0 else -1.0)-0.25*(F[ps[1]] if len(ps) > 1 else -1.0)
+        if len(ps) < 2:
+            F[i] = 0.0
+            continue
+        if couples.has_key(ps):
+            F[i] = couples[ps]
+            continue
+        fi = -1.0
+        L[i] = 1.0
+        j = i
+        while j != 0:
+            k = j
+            r = 0.5*L[j]
+            for parent in numbered[j]:
+                while point[k] > parent:
+                    k = point[k]
+                L[parent] += r
+                if parent != point[k]:
+                    point[parent] = point[k]
+                    point[k] = parent
+            fi += L[j]*L[j]*D[j]
+            L[j] = 0.0
+            k = j
+            j = point[j]
+            point[k] = 0
+        F[i] = fi
+        couples[ps] = fi
+    return [F[numbers[i]] for i in xrange(len(parents))]
+
+def _kinshipFamily(task):
+    # Kinship between every pair of the requested people in one family (None if the family has
+    # an ancestry loop, as there's no generation order to work in)
+    familyIndex, parents, people = task
+    order,acyclic = familyTopologicalOrder(parents, familyChildren(parents))
+    if not acyclic:
+        return (familyIndex, None)
+    position = [None]*len(parents)
+    for x,i in enumerate(order):
+        position[i] = x
+    pairs = [(a,b) for x,a in enumerate(people) for b in people[x+1:]]
+    return (familyIndex, zip(pairs, familyKinship(parents, position, pairs)))
+
+def _boundFamily(task):
+    '''
+    Cheap upper bounds on d for everyone in a family with more than one affected descendant.
+    Every pair term is at most meioses+1, and the meioses between two descendants are at most
+    the sum of their distances down from the ancestor, so d <= (sum of those distances) + k/2
+    for k affecteds. The distance sum is bounded from the bottom up by going through each child
+    (which counts descendants reachable through several children more than once, so it can only
+    overshoot) or by k times the number of generations below the person, whichever is smaller.
+    Returns (familyIndex, [(person, n_local_aff, n_local_desc, bound)]); bounds are infinite
+    in a family with an ancestry loop
+    '''
+    familyIndex, parents, affected = task
+    children = familyChildren(parents)
+    order,acyclic = familyTopologicalOrder(parents, children)
+    affectedMask = sum(1 << i for i,a in enumerate(affected) if a)
+    
+    descendants = [0]*len(parents)
+    height = [0]*len(parents)
+    distances = [0]*len(parents)
+    numAffected = [0]*len(parents)
+    results = []
+    for i in reversed(order):
+        if acyclic:
+            mask = 1 << i
+            for c in children[i]:
+                mask |= descendants[c]
+                height[i] = max(height[i],height[c]+1)
+        else:
+            mask = sum(1 << p for p in familyDescendants(children, i))
+        descendants[i] = mask
+        numAffected[i] = bin(mask & affectedMask).count('1')
+        distances[i] = min(sum(distances[c]+numAffected[c] for c in children[i]),numAffected[i]*height[i])
+        if numAffected[i] > 1:
+            bound = distances[i]+numAffected[i]/2.0 if acyclic else float('inf')
+            results.append((i, numAffected[i], bin(mask).count('1'), bound))
+    return (familyIndex, results)
+
+def _topFamily(task):
+    # Exact d (as _calculateFamily would work it out) for just the given people in one family
+    familyIndex, memberIDs, parents, affected, people = task
+    children = familyChildren(parents)
+    ancestry = familyAncestryIndex(parents, children)
+    meioses = familyMeiosesFunction(parents, children, set(i for i,a in enumerate(affected) if a))
+    
+    results = []
+    for i in people:
+        p_aff = sorted((p for p in familyDescendants(children, i) if affected[p]), key=memberIDs.__getitem__)
+        spouseSets = familySpouseSets(ancestry, familySpouses(parents, children, i), p_aff)
+        results.append((i, familyExactD(meioses, p_aff, spouseSets)))
+    return (familyIndex, results)
+
+def familyConnectingSet(parents, targets):
+    '''
+    The smallest part of a family that connects the targets: every line of descent from each
+    most recent common ancestor of a pair of targets down to the two of them. Only the targets'
+    ancestors can be on those lines, so bitmasks of targets below (T) and of descendants (D) are
+    only built over them. x is a most recent common ancestor of a and b if no child of x is an
+    ancestor of both, so a counts for x if the children above a don't cover all of T(x); the
+    lines from x down to a are then D(x) & ancestors(a). Returns a set of family indices
+    '''
+    children = familyChildren(parents)
+    targetBits = dict((t,x) for x,t in enumerate(targets))
+    
+    ancestors = {}
+    region = set()
+    for t in targets:
+        visited = set([t])
+        toVisit = deque([t])
+        while len(toVisit) > 0:
+            p = toVisit.popleft()
+            for parent in parents[p]:
+                if not parent in visited:
+                    visited.add(parent)
+                    toVisit.append(parent)
+        ancestors[t] = sum(1 << p for p in visited)
+        region.update(visited)
+    
+    order,acyclic = familyTopologicalOrder(parents, children)
+    below = {}
+    descendants = {}
+    for i in reversed(order):
+        if not i in region:
+            continue
+        if acyclic:
+            T = 1 << targetBits[i] if targetBits.has_key(i) else 0
+            D = 1 << i
+            for c in children[i]:
+                if c in region:
+                    T |= below[c]
+                    D |= descendants[c]
+        else:
+            reachable = [p for p in familyDescendants(children, i) if p in region]
+            T = sum(1 << targetBits[p] for p in reachable if targetBits.has_key(p))
+            D = sum(1 << p for p in reachable)
+        below[i] = T
+        descendants[i] = D
+    
+    result = 0
+    for i in region:
+        T = below[i]
+        if T & (T-1) == 0:
+            # Fewer than two targets below
+            continue
+        childSets = [below[c] for c in children[i] if c in region]
+        for x in maskMembers(T):
+            covered = 0
+            for childSet in childSets:
+                if childSet & (1 << x):
+                    covered |= childSet
+            if covered != T:
+                result |= descendants[i] & ancestors[targets[x]]
+    result |= sum(1 << t for t in targets)
+    return set(maskMembers(result))
+
+def trimUninformative(parents, affected, dropFounders=True):
+    '''
+    Which people are worth keeping, on dense IDs (parents[i] lists i's parents among the same
+    people): unaffected people are peeled off while they have no children left (which takes
+    care of married-in spouses with no affected descendants, once their children are gone), and
+    (if dropFounders) while they have no parents left and only one child. Each person only goes
+    on the worklist when one of their counters changes, so it's linear in the number of links.
+    Affected people are always kept. Returns a list of booleans
+    '''
+    children = familyChildren(parents)
+    numParents = [len(ps) for ps in parents]
+    numChildren = [len(cs) for cs in children]
+    kept = [True]*len(parents)
+    
+    def removable(i):
+        if not kept[i] or affected[i]:
+            return False
+        return numChildren[i] == 0 or (dropFounders and numParents[i] == 0 and numChildren[i] == 1)
+    
+    toVisit = [i for i in xrange(len(parents)) if removable(i)]
+    while len(toVisit) > 0:
+        i = toVisit.pop()
+        if not removable(i):
+            continue
+        kept[i] = False
+        for p in parents[i]:
+            if kept[p]:
+                numChildren[p] -= 1
+                toVisit.append(p)
+        for c in children[i]:
+            if kept[c]:
+                numParents[c] -= 1
+                toVisit.append(c)
+    return kept
+
+def familyAncestorDepths(parents, person):
+    # How many generations up each of the person's ancestors is (the person is 0 generations up)
+    depths = {person:0}
+    toVisit = deque([person])
+    while len(toVisit) > 0:
+        p = toVisit.popleft()
+        for parent in parents[p]:
+            if not depths.has_key(parent):
+                depths[parent] = depths[p]+1
+                toVisit.append(parent)
+    return depths
+
+def familyRelationship(children, depths1, depths2):
+    '''
+    How two people are related, given both of their ancestor depth maps: their closest common
+    ancestors (common ancestors none of whose children are also common ancestors, that are the
+    fewest meioses away from the pair), and the meioses from each person up to them. Returns
+    (meioses1, meioses2, closest common ancestors), or None if they aren't related
+    '''
+    small,large = (depths1,depths2) if len(depths1) <= len(depths2) else (depths2,depths1)
+    common = [a for a in small.iterkeys() if large.has_key(a)]
+    if len(common) == 0:
+        return None
+    recent = [a for a in common if not any(depths1.has_key(c) and depths2.has_key(c) for c in children[a])]
+    total = min(depths1[a]+depths2[a] for a in recent)
+    closest = sorted(a for a in recent if depths1[a]+depths2[a] == total)
+    return (depths1[closest[0]],depths2[closest[0]],closest)
+
+ORDINALS = ['first','second','third','fourth','fifth','sixth','seventh','eighth','ninth','tenth']
+REMOVALS = ['','once','twice','three times','four times','five times','six times','seven times','eight times','nine times','ten times']
+
+def relationshipName(meioses1, meioses2, numClosest):
+    '''
+    A name for a relationship (like "full first cousins once removed") and its degree; the degree
+    is the number of meioses, less one if the closest common ancestors are a couple (so that full
+    siblings and parent / child pairs are both first degree)
+    '''
+    low,high = sorted((meioses1,meioses2))
+    if low == 0:
+        if high == 0:
+            return ('self',0)
+        names = ['','parent / child','grandparent / grandchild','great-grandparent / great-grandchild']
+        return (names[high] if high < len(names) else '%ix great-grandparent / %ix great-grandchild' % (high-2,high-2),high)
+    prefix = {1:'half',2:'full',4:'double'}.get(numClosest,'complex')
+    degree = low+high-(1 if numClosest > 1 else 0)
+    if low == 1:
+        if high == 1:
+            return ('%s siblings' % prefix,degree)
+        greats = ['','','','great-','great-great-']
+        return ('%s %savuncular' % (prefix,greats[high] if high < len(greats) else '%ix great-' % (high-2)),degree)
+    name = '%s %s cousins' % (prefix,ORDINALS[low-2] if low-2 < len(ORDINALS) else '%ith' % (low-1))
+    if high > low:
+        name += ' %s removed' % (REMOVALS[high-low] if high-low < len(REMOVALS) else '%i times' % (high-low))
+    return (name,degree)
+
+def familyWithin(links, person, level):
+    # Same BFS as Pedigree.iterLevelsFrom, over one family's link lists; the person comes first
+    visited = set([person])
+    found = [person]
+    frontier = [person]
+    l = 0
+    while len(frontier) > 0 and l < level:
+        nextFrontier = []
+        for p in frontier:
+            for p2 in links[p]:
+                if not p2 in visited:
+                    visited.add(p2)
+                    nextFrontier.append(p2)
+        found.extend(nextFrontier)
+        frontier = nextFrontier
+        l += 1
+    return found
+
+def familyWithinFunction(links):
+    # familyWithin from one person after another; these are mostly short, so the numpy kernel
+    # (which pays for every level) doesn't help, only the numba one does
+    kernels = loadKernels(len(links))
+    if kernels != None and kernels.LAYER == 'numba':
+        return kernels.familyWithinFunction(links)
+    return lambda person, level: familyWithin(links, person, level)
+
+def _cohortFamily(task):
+    '''
+    Everyone within up generations above each proband, plus everyone within down steps below any
+    of those (spouse links count as steps on the way down if withSpouses), for a batch of probands
+    from one family. The downward traversals are kept (up to maxCached people in total) and reused
+    by every proband that shares that ancestor; when down is unlimited, only the topmost ancestors
+    need one, because everyone else's descendants are already below them
+    '''
+    familyIndex,parents,probands,up,down,withSpouses,maxCached = task
+    if isinstance(parents,str):
+        # The path to a SharedPedigreeArrays, rather than the arrays themselves
+        from shared_arrays import SharedPedigreeArrays
+        parents = SharedPedigreeArrays.attach(parents).familyParents(familyIndex)
+    children = familyChildren(parents)
+    downLinks = children
+    if withSpouses:
+        downLinks = [children[i] + sorted(familySpouses(parents, children, i) - set([i])) for i in xrange(len(parents))]
+    withinUp = familyWithinFunction(parents)
+    withinDown = familyWithinFunction(downLinks)
+    cache = {}
+    numCached = 0
+    results = []
+    for position,p in probands:
+        ancestors = withinUp(p, up)
+        if down <= 0:
+            results.append((position,sorted(ancestors)))
+            continue
+        sources = ancestors
+        if math.isinf(down):
+            inSet = set(ancestors)
+            sources = [a for a in ancestors if not any(parent in inSet for parent in parents[a])]
+        members = set()
+        for s in sources:
+            if not cache.has_key(s):
+                if numCached > maxCached:
+                    cache = {}
+                    numCached = 0
+                cache[s] = withinDown(s, down)
+                numCached += len(cache[s])
+            members.update(cache[s])
+        results.append((position,sorted(members)))
+    return (familyIndex,results)
+
 class Pedigree(object):
     CHILD_TO_PARENT = 1
     PARENT_TO_CHILD = 2
@@ -99,35 +930,118 @@ class Pedigree(object):
                      'is_root':'is_root',
                      'is_leaf':'is_leaf',
                      'generation':'generation'}
+    # Extra columns that are only written when they're asked for (or that files calculated by
+    # older versions won't have, so vis can't require them)
+    OPTIONAL_KEYS = {'inbreeding':'inbreeding',
+                     'nicki_d_p':'nicki_d_p',
+                     'nicki_d_approx':'nicki_d_approx',
+                     'nicki_d_low':'nicki_d_low',
+                     'nicki_d_high':'nicki_d_high',
+                     'n_local_aff_null':'n_local_aff_null',
+                     'n_local_aff_drop_p':'n_local_aff_drop_p',
+                     'nicki_d_null':'nicki_d_null',
+                     'nicki_d_drop_p':'nicki_d_drop_p',
+                     'n_local_aff_expected':'n_local_aff_expected',
+                     'n_local_aff_ratio':'n_local_aff_ratio',
+                     'n_local_aff_enrichment_p':'n_local_aff_enrichment_p'}
     
     INV_LOG_TWO = 1.0/math.log(2.0)
     
     KEY_ERROR = KeyError('dummy')
     
-    NUM_STEPS = 5
+    NUM_STEPS = 4
+    
+    # Goes up whenever what gets cached for a family changes
+    CACHE_VERSION = 2
     
     MAX_CATEGORIES = 12
     
-    def __init__(self, path, countAndCalculate=True, zeroMissing=False, tickFunction=None, numTicks=None):
+    def __init__(self, path, countAndCalculate=True, zeroMissing=False, tickFunction=None, numTicks=None, numProcesses=1, phenotypes=None,
+                 maxExactAffected=None, pairBudget=100000, seed=0,
+                 checkpointPath=None, checkpointInterval=300, resume=False, cachePath=None, statistics=None,
+                 queuePath=None, queueTimeout=600, queueUnitSize=None):
         self.g = networkx.DiGraph()
         self.rowOrder = []
+        # The same links as self.g, split up by type so that traversals only see what they ask for;
+        # linkVersion goes up whenever they change, so that anything caching traversals can tell
+        self.links = dict((t,{}) for t in Pedigree.EDGE_TYPES.iterkeys())
+        self.linkVersion = 0
         self.extraNodeAttributes = []
         
         self.attrDetails = {}
         
         self.minGeneration = 0
         self.maxGeneration = 0
+        self.generationConflicts = []
         self.roots = set()
         self.leaves = set()
         
+        # Connected families, largest first, and a lookup from person to family index
+        self.families = []
+        self.familyLookup = {}
+        
+        # Each person's position within their family, and each family's familyAncestryIndex
+        self.familyPositions = {}
+        self.ancestryIndex = []
+        
         self.tickFunction = tickFunction
         self.numTicks = numTicks
+        self.numProcesses = numProcesses
+        
+        # Affected columns to count and calculate d for; the first is always the required affected
+        # column. With more than one, each phenotype gets its own n_local_aff_* and nicki_d_* columns
+        self.phenotypes = [Pedigree.REQUIRED_KEYS['affected']]
+        if phenotypes != None:
+            for phenotype in phenotypes:
+                if not phenotype in self.phenotypes:
+                    self.phenotypes.append(phenotype)
+        
+        # FamilyStatistics worked out for everyone while counting; the built-in ones come first, and
+        # any extras get their own columns
+        self.statistics = [IsRootStatistic(),IsLeafStatistic()]
+        self.numBuiltInStatistics = len(self.statistics)
+        if statistics != None:
+            self.statistics.extend(statistics)
+        
+        # If set, d is estimated from about pairBudget sampled pairs for anyone with more than
+        # maxExactAffected affected descendants
+        self.maxExactAffected = maxExactAffected
+        self.pairBudget = pairBudget
+        self.seed = seed
+        
+        # If set, counting and d progress gets saved to checkpointPath every checkpointInterval
+        # seconds (and on Ctrl-C); resume picks up where the last checkpoint left off
+        self.checkpointPath = checkpointPath
+        self.checkpointInterval = checkpointInterval
+        self.resume = resume
+        self.checkpointSignature = (os.path.abspath(path),os.path.getsize(path),os.path.getmtime(path),zeroMissing)
+        
+        # If set, per-family results are kept in cachePath between runs, keyed by a hash of each
+        # family's contents; only families that have changed get recalculated
+        self.cachePath = cachePath
+        
+        # If set, families get counted and calculated by queueWorker.py processes (on any host that
+        # can see queuePath) instead of a local pool; families with more than queueUnitSize people
+        # are split into runs of that many, unless d is being estimated. See _queueFamilies
+        self.queuePath = queuePath
+        self.queueTimeout = queueTimeout
+        self.queueUnitSize = queueUnitSize
+        
+        # (linkVersion, SharedPedigreeArrays) once process pools have needed them; see _getSharedArrays
+        self.sharedArrays = None
+        
+        # Everyone with a generation, sorted by it (see _indexGenerations); setting anyone's
+        # generation sets this back to None, and it gets rebuilt the next time it's needed
+        self.generationIndex = None
         
         # TODO: parse other file formats based on their extension
         self._parseEgoPaMa(path, countAndCalculate, zeroMissing)
+        self._labelFamilies()
+        self._indexAncestry()
         
         if countAndCalculate:
             self._countAndCalculate()
+        self._indexGenerations()
     
     def _parseEgoPaMa(self, path, countAndCalculate, zeroMissing):
         if self.tickFunction != None:
@@ -135,6 +1049,7 @@ class Pedigree(object):
         
         required_indices = {}
         reserved_indices = {}
+        phenotype_indices = set()
         
         notMissing = set()
         if zeroMissing:
@@ -167,6 +1082,16 @@ class Pedigree(object):
                         else:
                             reserved_indices[k] = len(header)
                             header.append(v)
+                    for phenotype in self.phenotypes:
+                        if phenotype not in header:
+                            raise Exception('Phenotype header "%s" not in file.' % phenotype)
+                        phenotype_indices.add(header.index(phenotype))
+                        if countAndCalculate and len(self.phenotypes) > 1:
+                            for v in [Pedigree.getPhenotypeKey('n_local_aff',phenotype),Pedigree.getPhenotypeKey('nicki_d',phenotype)]:
+                                if v in header:
+                                    sys.stderr.write('WARNING: "%s" is a reserved header - this column may be overwritten.\n' % v)
+                                else:
+                                    header.append(v)
                     for h in header:
                         self.attrDetails[h] = AttributeDetails(Pedigree.MAX_CATEGORIES)
                     self.extraNodeAttributes = list(header)
@@ -196,7 +1121,7 @@ class Pedigree(object):
                                     attribs[i] = 'M'
                                 elif attribs[i] == '2':
                                     attribs[i] = 'F'
-                        elif i == required_indices['affected'] or i == reserved_indices.get('is_root',None) or i == reserved_indices.get('is_leaf',None):
+                        elif i in phenotype_indices or i == reserved_indices.get('is_root',None) or i == reserved_indices.get('is_leaf',None):
                             if a != '0' and a != '1':
                                 attribs[i] = None
                             else:
@@ -226,17 +1151,17 @@ class Pedigree(object):
                     paID = self.getAttribute(personID, 'paID', '0')
                     maID = self.getAttribute(personID, 'maID', '0')
                     if paID != '0':
-                        self.g.add_edge(personID,paID,{'type':Pedigree.CHILD_TO_PARENT})
-                        self.g.add_edge(paID,personID,{'type':Pedigree.PARENT_TO_CHILD})
+                        self._addLink(personID,paID,Pedigree.CHILD_TO_PARENT)
+                        self._addLink(paID,personID,Pedigree.PARENT_TO_CHILD)
                         self.setAttribute(paID, 'sex', 'M')
                     if maID != '0':
-                        self.g.add_edge(personID,maID,{'type':Pedigree.CHILD_TO_PARENT})
-                        self.g.add_edge(maID,personID,{'type':Pedigree.PARENT_TO_CHILD})
+                        self._addLink(personID,maID,Pedigree.CHILD_TO_PARENT)
+                        self._addLink(maID,personID,Pedigree.PARENT_TO_CHILD)
                         self.setAttribute(maID, 'sex', 'F')
                     # If I write my own dijkstra's for self.countAndCalculate, I could always just add the marriage links here
                     if not countAndCalculate and paID != '0' and maID != '0':
-                        self.g.add_edge(paID,maID,{'type':Pedigree.HUSBAND_TO_WIFE})
-                        self.g.add_edge(maID,paID,{'type':Pedigree.WIFE_TO_HUSBAND})
+                        self._addLink(paID,maID,Pedigree.HUSBAND_TO_WIFE)
+                        self._addLink(maID,paID,Pedigree.WIFE_TO_HUSBAND)
                     
                     # Finally keep track of the kinds of data we've seen
                     for a,v in self.g.node[personID].iteritems():
@@ -252,81 +1177,401 @@ class Pedigree(object):
         if self.tickFunction != None:
             self.tickFunction(increment=int(self.numTicks/Pedigree.NUM_STEPS))
     
-    def _countAndCalculate(self):
-        # TODO: If I write my own dijkstra's, I can just toss this and use the real one
-        def stupidIterSpouses(person):
-            visited = set()
-            for child in self.iterChildren(person):
-                for spouse in self.iterParents(child):
-                    if spouse in visited:
+    def _labelFamilies(self):
+        # One union-find pass over parent links; spouses only ever meet through a child, so this
+        # is enough to find every connected family
+        index = {}
+        for i,p in enumerate(self.rowOrder):
+            index[p] = i
+        uf = range(len(self.rowOrder))
+        sizes = [1]*len(self.rowOrder)
+        
+        def find(i):
+            root = i
+            while uf[root] != root:
+                root = uf[root]
+            while uf[i] != root:
+                uf[i],i = root,uf[i]
+            return root
+        
+        for i,p in enumerate(self.rowOrder):
+            for parent in self.iterParents(p):
+                a = find(i)
+                b = find(index[parent])
+                if a == b:
+                    continue
+                if sizes[a] < sizes[b]:
+                    a,b = b,a
+                uf[b] = a
+                sizes[a] += sizes[b]
+        
+        members = {}
+        for i,p in enumerate(self.rowOrder):
+            members.setdefault(find(i),[]).append(p)
+        # Largest first so that the big jobs don't end up straggling at the end
+        self.families = sorted(members.itervalues(), key=len, reverse=True)
+        self.familyLookup = {}
+        for f,family in enumerate(self.families):
+            for p in family:
+                self.familyLookup[p] = f
+    
+    def _indexAncestry(self):
+        self.familyPositions = {}
+        self.ancestryIndex = []
+        for family in self.families:
+            for i,p in enumerate(family):
+                self.familyPositions[p] = i
+            parents = self._getFamilyParents(family)
+            self.ancestryIndex.append(familyAncestryIndex(parents, familyChildren(parents)))
+    
+    def getFamily(self, person):
+        return self.families[self.familyLookup[person]]
+    
+    @staticmethod
+    def getPhenotypeKey(a, phenotype):
+        a = Pedigree.RESERVED_KEYS.get(a,a)
+        a = Pedigree.OPTIONAL_KEYS.get(a,a)
+        return '%s_%s' % (a,phenotype)
+    
+    def _getFamilyParents(self, family):
+        # Parents as indices into the family's member list
+        index = {}
+        for i,p in enumerate(family):
+            index[p] = i
+        return [tuple(index[parent] for parent in self.iterParents(p)) for p in family]
+    
+    def _getFamilyTask(self, familyIndex):
+        family = self.families[familyIndex]
+        parents = self._getFamilyParents(family)
+        affected = []
+        for p in family:
+            mask = 0
+            for j,phenotype in enumerate(self.phenotypes):
+                if self.getAttribute(p, phenotype, None) == True:
+                    mask |= 1 << j
+            affected.append(mask)
+        approximation = None
+        if self.maxExactAffected != None:
+            approximation = (self.maxExactAffected, self.pairBudget, self.seed)
+        checkpoint = None
+        if self.checkpointPath != None and self.queuePath == None:
+            checkpoint = (self._getFamilyCheckpointPath(familyIndex), self.checkpointInterval, self.resume, self._getCheckpointSignature())
+        attributes = [[[self.getAttribute(p, a, None) for a in statistic.attributes] for statistic in self.statistics] for p in family]
+        return (familyIndex, family, parents, affected, len(self.phenotypes), approximation, checkpoint, self.statistics, attributes,
+                self.ancestryIndex[familyIndex], None)
+    
+    def _storeFamilyResult(self, result):
+        familyIndex,statisticValues,nLocalAff,nickiD,intervals = result
+        for i,p in enumerate(self.families[familyIndex]):
+            for k,values in statisticValues.iteritems():
+                self.setAttribute(p, k, values[i])
+            if statisticValues['is_root'][i]:
+                self.roots.add(p)
+            if statisticValues['is_leaf'][i]:
+                self.leaves.add(p)
+            for j,phenotype in enumerate(self.phenotypes):
+                values = {'n_local_aff':nLocalAff[j][i],
+                          'nicki_d':nickiD[j][i]}
+                if self.maxExactAffected != None:
+                    values['nicki_d_approx'] = None if nickiD[j][i] == None else intervals[j][i] != None
+                    values['nicki_d_low'],values['nicki_d_high'] = intervals[j][i] or (None,None)
+                for k,v in values.iteritems():
+                    if j == 0:
+                        self.setAttribute(p, k, v)
+                    if len(self.phenotypes) > 1:
+                        self.setAttribute(p, Pedigree.getPhenotypeKey(k, phenotype), v)
+    
+    def _getFamilyKey(self, familyIndex):
+        family = self.families[familyIndex]
+        return '%s-%i' % (family[0],len(family))
+    
+    def _getFamilyCheckpointPath(self, familyIndex):
+        return '%s.%s' % (self.checkpointPath,self._getFamilyKey(familyIndex))
+    
+    def _getStatisticsSignature(self):
+        return tuple((statistic.__class__.__name__,sorted(vars(statistic).iteritems())) for statistic in self.statistics)
+    
+    def _getCheckpointSignature(self):
+        return self.checkpointSignature + (tuple(self.phenotypes),self.maxExactAffected,self.pairBudget,self.seed,self._getStatisticsSignature())
+    
+    def _getFamilyHash(self, familyIndex):
+        # Everything that goes into a family's results: its people (in order), their parent links,
+        # affected statuses, the attributes the statistics need and any generations they came
+        # with, plus the settings for d and the statistics themselves
+        family = self.families[familyIndex]
+        task = self._getFamilyTask(familyIndex)
+        contents = (Pedigree.CACHE_VERSION, family, task[2], task[3], task[4], task[5], task[8], self._getStatisticsSignature(),
+                    [self.getAttribute(p, 'generation', None) for p in family])
+        return hashlib.sha1(repr(contents)).hexdigest()
+    
+    def _loadCache(self):
+        if self.cachePath == None or not os.path.exists(self.cachePath):
+            return {}
+        try:
+            return readCheckpoint(self.cachePath)
+        except Exception, e:
+            sys.stderr.write('WARNING: Could not read the cache at %s (%s) - starting from scratch.\n' % (self.cachePath,e))
+            return {}
+    
+    def _loadCheckpoint(self):
+        # Finished families' results, keyed by _getFamilyKey
+        if not self.resume:
+            return {}
+        if not os.path.exists(self.checkpointPath):
+            sys.stderr.write('WARNING: No checkpoint at %s - starting from scratch.\n' % self.checkpointPath)
+            self.resume = False
+            return {}
+        signature,completed = readCheckpoint(self.checkpointPath)
+        if signature != self._getCheckpointSignature():
+            raise Exception('Checkpoint %s was made from a different file or with different settings.' % self.checkpointPath)
+        return completed
+    
+    def removeCheckpoint(self):
+        if self.checkpointPath != None and os.path.exists(self.checkpointPath):
+            os.remove(self.checkpointPath)
+    
+    def _addColumn(self, a):
+        a = Pedigree.OPTIONAL_KEYS.get(a,a)
+        if a in self.extraNodeAttributes:
+            sys.stderr.write('WARNING: "%s" is already a column - it will be overwritten.\n' % a)
+        else:
+            self.extraNodeAttributes.append(a)
+            self.attrDetails[a] = AttributeDetails(Pedigree.MAX_CATEGORIES)
+        return a
+    
+    def _addLink(self, s, t, edgeType):
+        # There's only room for one link from s to t, so a new type replaces the old one
+        previous = self.getLink(s, t)
+        if previous == edgeType:
+            return
+        if previous != None:
+            self.links[previous][s].remove(t)
+        self.g.add_edge(s,t,{'type':edgeType})
+        self.links[edgeType].setdefault(s,[]).append(t)
+        self.linkVersion += 1
+    
+    def _addSpouseLinks(self, family):
+        for p in family:
+            paID = self.dad(p)
+            maID = self.mom(p)
+            if paID != None and maID != None:
+                self._addLink(paID,maID,Pedigree.HUSBAND_TO_WIFE)
+                self._addLink(maID,paID,Pedigree.WIFE_TO_HUSBAND)
+    
+    def _mapFamilies(self, function, tasks):
+        # Runs function over the family tasks, in parallel if we can; results come back in whatever
+        # order they finish
+        if self.numProcesses > 1 and len(self.families) > 1:
+            pool = multiprocessing.Pool(self.numProcesses)
+            results = pool.imap_unordered(function, tasks)
+            try:
+                while True:
+                    # Waiting with a timeout is what lets Ctrl-C through to this process
+                    try:
+                        result = results.next(3600)
+                    except multiprocessing.TimeoutError:
                         continue
-                    visited.add(spouse)
-                    yield spouse
+                    except StopIteration:
+                        break
+                    yield result
+            except:
+                pool.terminate()
+                raise
+            pool.close()
+            pool.join()
+        else:
+            for result in itertools.imap(function, tasks):
+                yield result
+    
+    def _queueFamilies(self, familyIndices, wait=5):
+        '''
+        Same results as running _calculateFamily over the families through _mapFamilies, but the
+        work goes out through a WorkQueue at queuePath, for queueWorker.py processes to pick up; this
+        checks for finished units every wait seconds, and puts failed or abandoned units back. Each
+        unit holds about queueUnitSize people: either a run of small families, or a span of a big
+        one. Units are named after their first family, so a restarted coordinator picks up the ones
+        that were already finished; each unit's results come back with the family keys and spans
+        it was made from, and any that don't match this run's plan get worked out again. A family
+        that was split up comes out once every span is in
+        '''
+        queue = WorkQueue(self.queuePath, self.queueTimeout)
+        queue.start(self._getCheckpointSignature() + (self.queueUnitSize,))
+        unitSize = self.queueUnitSize or 1
+        # Unit name -> [(family index, span number, number of spans, span)]
+        units = {}
+        def getContents(name):
+            return [(self._getFamilyKey(f),span) for f,s,numSpans,span in units[name]]
+        def putUnit(name):
+            tasks = []
+            for f,s,numSpans,span in units[name]:
+                task = self._getFamilyTask(f)
+                tasks.append(task[:-1] + (span,))
+            queue.put(name, _calculateUnit, (getContents(name),tasks))
+        
+        batch = []
+        batchSize = 0
+        def putBatch():
+            name = '%07i.%05i' % (batch[0],0)
+            units[name] = [(b,0,1,None) for b in batch]
+            putUnit(name)
+        for f in familyIndices:
+            size = len(self.families[f])
+            if self.queueUnitSize != None and self.maxExactAffected == None and size > self.queueUnitSize:
+                # Estimates have to draw from one random sequence per family, so they can't be split
+                spans = [(start,min(size,start+unitSize)) for start in xrange(0,size,unitSize)]
+                for s,span in enumerate(spans):
+                    name = '%07i.%05i' % (f,s)
+                    units[name] = [(f,s,len(spans),span)]
+                    putUnit(name)
+                continue
+            if batchSize + size > unitSize and len(batch) > 0:
+                putBatch()
+                batch = []
+                batchSize = 0
+            batch.append(f)
+            batchSize += size
+        if len(batch) > 0:
+            putBatch()
         
-        # Flag roots and leaves, count descendants, collect affecteds, get starting point for generation counting
+        parts = {}
+        numFamilies = 0
+        remaining = set(units.iterkeys())
+        while len(remaining) > 0:
+            numFound = 0
+            for name,(contents,unitResults) in queue.collect(remaining):
+                if contents != getContents(name) or len(unitResults) != len(units[name]):
+                    # Left over from a run that split the families up differently
+                    sys.stderr.write('WARNING: Work unit %s was made for a different run - working it out again.\n' % name)
+                    queue.discard(name)
+                    putUnit(name)
+                    continue
+                remaining.discard(name)
+                numFound += 1
+                for (f,s,numSpans,span),result in itertools.izip(units[name], unitResults):
+                    if numSpans == 1:
+                        numFamilies += 1
+                        yield result
+                        continue
+                    parts.setdefault(f,{})[s] = result
+                    if len(parts[f]) == numSpans:
+                        results = [parts[f][s] for s in xrange(numSpans)]
+                        del parts[f]
+                        nickiD = [sum((r[3][j] for r in results),[]) for j in xrange(len(self.phenotypes))]
+                        intervals = [sum((r[4][j] for r in results),[]) for j in xrange(len(self.phenotypes))]
+                        if len(nickiD[0]) != len(self.families[f]):
+                            raise Exception('The work units for family %i only came back with %i of its %i people.' % (f,len(nickiD[0]),len(self.families[f])))
+                        numFamilies += 1
+                        yield (f,results[0][1],results[0][2],nickiD,intervals)
+            queue.requeue()
+            if numFound == 0:
+                time.sleep(wait)
+        if numFamilies != len(familyIndices):
+            raise Exception('Only %i of %i families came back from the work queue.' % (numFamilies,len(familyIndices)))
+        queue.finish()
+    
+    def publishArrays(self, attributes=None, path=None):
+        '''
+        Saves the pedigree's core arrays (an ID lookup, every family's parent and child lists, and
+        columns for the given attributes - all of the extra columns by default) as a
+        SharedPedigreeArrays, that other processes can attach to by its path and map in read-only
+        rather than having them pickled over; requires numpy
+        '''
+        from shared_arrays import SharedPedigreeArrays
+        return SharedPedigreeArrays.publish(self, attributes, path)
+    
+    def _getSharedArrays(self):
+        # Just the structure, published once (until the links change) for process pools to share;
+        # None if there's no numpy
+        if self.sharedArrays == None or self.sharedArrays[0] != self.linkVersion:
+            try:
+                arrays = self.publishArrays([])
+            except ImportError:
+                return None
+            if self.sharedArrays != None:
+                self.sharedArrays[1].close()
+            self.sharedArrays = (self.linkVersion,arrays)
+        return self.sharedArrays[1]
+    
+    def _tickFamilies(self, message, peopleDone, peopleBefore, steps=1):
+        # Spread a step's worth of ticks over families, proportional to their size
+        if self.tickFunction == None:
+            return
+        totalTicks = int(steps*self.numTicks/Pedigree.NUM_STEPS)
+        previous = totalTicks*peopleBefore/len(self.rowOrder)
+        current = totalTicks*peopleDone/len(self.rowOrder)
+        self.tickFunction(newMessage=message,increment=current-previous)
+    
+    def _countAndCalculate(self):
+        # Roots and leaves get flagged along with the other family statistics
         if self.tickFunction != None:
             self.tickFunction(newMessage='Counting...',increment=0)
         
         self.roots = set()
         self.leaves = set()
-        for p in self.rowOrder:
-            root = self.isRoot(p)
-            self.setAttribute(p, 'is_root', root)
-            if root:
-                self.roots.add(p)
-            
-            leaf = self.isLeaf(p)
-            self.setAttribute(p, 'is_leaf', leaf)
-            if leaf:
-                self.leaves.add(p)
-            
-            self.setAttribute(p, 'n_local_desc', 0)
-            self.setAttribute(p, 'n_local_aff', set())
-            for d in self.iterDown(p):
-                self.setAttribute(p, 'n_local_desc', self.getAttribute(p, 'n_local_desc') + 1)
-                if self.getAttribute(d, 'affected', None) == True:
-                    self.getAttribute(p, 'n_local_aff').add(d)
-            # We need a consistent ordering of affecteds to calculate d
-            self.setAttribute(p, 'n_local_aff', sorted(self.getAttribute(p, 'n_local_aff')))
-        if self.tickFunction != None:
-            self.tickFunction(increment=int(self.numTicks/Pedigree.NUM_STEPS))
+        self._addColumn('inbreeding')
+        for statistic in self.statistics[self.numBuiltInStatistics:]:
+            self._addColumn(statistic.key)
         
-        # Calculate d
-        if self.tickFunction != None:
-            self.tickFunction(newMessage='Calculating d...',increment=0)
-        for p in self.rowOrder:
-            p_aff = self.getAttribute(p, 'n_local_aff')
-            if len(p_aff) <= 1:
-                self.setAttribute(p, 'nicki_d', None)
-            else:
-                d = 0.0
-                for i,a in enumerate(p_aff):
-                    for b in p_aff[i+1:]:
-                        meioses = networkx.dijkstra_path_length(self.g, a, b, 1.0)
-                        commonAncestors = 1.0
-                        for s in stupidIterSpouses(p):
-                            s_aff = self.getAttribute(s, 'n_local_aff')
-                            if a in s_aff and b in s_aff:
-                                commonAncestors += 1.0
-                        d += -math.log(commonAncestors*0.5**(meioses+1))*Pedigree.INV_LOG_TWO
-                self.setAttribute(p, 'nicki_d', d/(len(p_aff)-1))
-        # Okay, we don't need the lists anymore... just keep the counts
-        for p in self.rowOrder:
-            self.setAttribute(p, 'n_local_aff', len(self.getAttribute(p, 'n_local_aff')))
-        if self.tickFunction != None:
-            self.tickFunction(increment=int(self.numTicks/Pedigree.NUM_STEPS))
+        if self.maxExactAffected != None:
+            for k in ['nicki_d_approx','nicki_d_low','nicki_d_high']:
+                self._addColumn(k)
+                if len(self.phenotypes) > 1:
+                    for phenotype in self.phenotypes:
+                        self._addColumn(Pedigree.getPhenotypeKey(k, phenotype))
         
-        # Now add spouse links - if I write my own dijkstra's for this method, I can toss this last section too
-        if self.tickFunction != None:
-            self.tickFunction(newMessage='Adding spouse links...',increment=0)
-        for p in self.rowOrder:
-            paID = self.dad(p)
-            maID = self.mom(p)
-            if paID != None and maID != None:
-                self.g.add_edge(paID,maID,{'type':Pedigree.HUSBAND_TO_WIFE})
-                self.g.add_edge(maID,paID,{'type':Pedigree.WIFE_TO_HUSBAND})
-        if self.tickFunction != None:
-            self.tickFunction(increment=int(self.numTicks/Pedigree.NUM_STEPS))
+        # Count descendants and calculate d, one family at a time (in parallel if we can); families
+        # that were finished before the last checkpoint, or that haven't changed since they were
+        # cached, come straight out of the checkpoint or cache
+        cache = self._loadCache()
+        hashes = []
+        cached = {}
+        if self.cachePath != None:
+            hashes = [self._getFamilyHash(f) for f in xrange(len(self.families))]
+            for f,h in enumerate(hashes):
+                if cache.has_key(h):
+                    cached[f] = cache[h]
+        
+        completed = {}
+        if self.checkpointPath != None:
+            completed = self._loadCheckpoint()
+            writeCheckpoint(self.checkpointPath, (self._getCheckpointSignature(),completed))
+            lastCheckpoint = time.time()
+        for f,entry in cached.iteritems():
+            completed.setdefault(self._getFamilyKey(f), entry[:4])
+        finished = [f for f in xrange(len(self.families)) if completed.has_key(self._getFamilyKey(f))]
+        remaining = [f for f in xrange(len(self.families)) if not completed.has_key(self._getFamilyKey(f))]
+        if self.queuePath != None:
+            calculated = self._queueFamilies(remaining)
+        else:
+            calculated = self._mapFamilies(_calculateFamily, itertools.imap(self._getFamilyTask, remaining))
+        results = itertools.chain(((f,)+completed[self._getFamilyKey(f)] for f in finished), calculated)
+        
+        peopleDone = 0
+        try:
+            for familyNumber,result in enumerate(results):
+                self._storeFamilyResult(result)
+                familyIndex = result[0]
+                family = self.families[familyIndex]
+                # Marriage links can only go in once the family's counted (a marriage link would
+                # replace a parent link between the same two people)
+                self._addSpouseLinks(family)
+                completed[self._getFamilyKey(familyIndex)] = result[1:]
+                if self.checkpointPath != None:
+                    if os.path.exists(self._getFamilyCheckpointPath(familyIndex)):
+                        os.remove(self._getFamilyCheckpointPath(familyIndex))
+                    if time.time() - lastCheckpoint > self.checkpointInterval:
+                        writeCheckpoint(self.checkpointPath, (self._getCheckpointSignature(),completed))
+                        lastCheckpoint = time.time()
+                self._tickFamilies('Counting and calculating d for family %i of %i (%i people)...' % (familyNumber+1,len(self.families),len(family)),
+                                   peopleDone+len(family), peopleDone, steps=2)
+                peopleDone += len(family)
+        except KeyboardInterrupt:
+            if self.checkpointPath != None:
+                writeCheckpoint(self.checkpointPath, (self._getCheckpointSignature(),completed))
+                sys.stderr.write('WARNING: Interrupted - saved a checkpoint to %s.\n' % self.checkpointPath)
+            raise
+        if self.checkpointPath != None:
+            writeCheckpoint(self.checkpointPath, (self._getCheckpointSignature(),completed))
         
         # Calculate generations - this is similar to rank in the dot layout algorithm
         if self.tickFunction != None:
@@ -334,25 +1579,392 @@ class Pedigree(object):
         
         self.maxGeneration = 0
         self.minGeneration = 0
-        genSetOnce = False
-        for p in self.rowOrder:
-            if not self.hasAttribute(p, 'generation'):
-                if not genSetOnce:
-                    p2 = p
-                    startingGen = 0
-                    genSetOnce = True
-                else:
-                    p2,startingGen = self._findMarriageWithDefinedGeneration(p)
-                    if p2 == None:
-                        p2 = p
-                        startingGen = 0
-                for p3,gen in self.iterGenerations(p2,startingGen):
-                    self.setAttribute(p3, 'generation', gen)
-                    self.maxGeneration = max(self.maxGeneration,gen)
-                    self.minGeneration = min(self.minGeneration,gen)
+        self.generationConflicts = []
+        peopleDone = 0
+        for familyIndex,family in enumerate(self.families):
+            if cached.has_key(familyIndex):
+                generations,conflicts = cached[familyIndex][4:]
+                for p,g in itertools.izip(family,generations):
+                    self.setAttribute(p, 'generation', g)
+                    if g != None:
+                        self.maxGeneration = max(self.maxGeneration,g)
+                        self.minGeneration = min(self.minGeneration,g)
+                self.generationConflicts.extend((family[i1],g1,family[i2],g2) for i1,g1,i2,g2 in conflicts)
+            else:
+                numConflicts = len(self.generationConflicts)
+                self._assignFamilyGenerations(family)
+                if self.cachePath != None:
+                    index = dict((p,i) for i,p in enumerate(family))
+                    conflicts = [(index[p1],g1,index[p2],g2) for p1,g1,p2,g2 in self.generationConflicts[numConflicts:]]
+                    generations = [self.getAttribute(p, 'generation', None) for p in family]
+                    cached[familyIndex] = completed[self._getFamilyKey(familyIndex)] + (generations,conflicts)
+            self._tickFamilies(None, peopleDone+len(family), peopleDone)
+            peopleDone += len(family)
+        
+        # Only the current families are kept, so the cache doesn't grow from release to release
+        if self.cachePath != None:
+            writeCheckpoint(self.cachePath, dict((hashes[f],entry) for f,entry in cached.iteritems()))
+        for p1,g1,p2,g2 in self.generationConflicts:
+            sys.stderr.write('WARNING: Conflicting generations: %s (generation %i) has a %s link to %s (generation %i).\n' %
+                             (p1,g1,Pedigree.EDGE_TYPES[self.getLink(p1,p2)],p2,g2))
+    
+    def findTopAncestors(self, k=50, by='nicki_d', batchSize=None):
+        '''
+        The k people with the highest d (or n_local_aff), without calculating d for everyone:
+        cheap upper bounds (see _boundFamily) put every candidate in a priority queue, and exact
+        d is only worked out for the best-bounded batchSize candidates at a time until no bound
+        left in the queue can beat the k-th best d so far. Returns a ranked list of (personID,
+        n_local_aff, n_local_desc, nicki_d). Works on a pedigree loaded without countAndCalculate
+        '''
+        if by != 'nicki_d' and by != 'n_local_aff':
+            raise Exception('Can only rank ancestors by nicki_d or n_local_aff, not %s.' % by)
+        if batchSize == None:
+            batchSize = max(k,4*self.numProcesses)
+        affected = [[self.getAttribute(p, 'affected', None) == True for p in family] for family in self.families]
         
         if self.tickFunction != None:
-            self.tickFunction(increment=int(self.numTicks/Pedigree.NUM_STEPS))
+            self.tickFunction(newMessage='Bounding d...',increment=0)
+        tasks = [(f, self._getFamilyParents(family), affected[f]) for f,family in enumerate(self.families) if sum(affected[f]) > 1]
+        counts = {}
+        queue = []
+        for familyIndex,results in self._mapFamilies(_boundFamily, tasks):
+            for i,numAffected,numDescendants,bound in results:
+                counts[(familyIndex,i)] = (numAffected,numDescendants)
+                if by == 'nicki_d':
+                    queue.append((-bound,familyIndex,i))
+                else:
+                    queue.append((-numAffected,self.families[familyIndex][i],familyIndex,i))
+        heapq.heapify(queue)
+        
+        def calculate(candidates):
+            byFamily = {}
+            for familyIndex,i in candidates:
+                byFamily.setdefault(familyIndex,[]).append(i)
+            tasks = [(f, self.families[f], self._getFamilyParents(self.families[f]), affected[f], people) for f,people in byFamily.iteritems()]
+            for familyIndex,results in self._mapFamilies(_topFamily, tasks):
+                for i,d in results:
+                    yield (familyIndex,i,d)
+        
+        if by == 'n_local_aff':
+            candidates = [heapq.heappop(queue)[2:] for x in xrange(min(k,len(queue)))]
+            found = list(calculate(candidates))
+        else:
+            # The k best so far, worst on top
+            found = []
+            numCalculated = 0
+            while len(queue) > 0 and (len(found) < k or -queue[0][0] > found[0][0]):
+                candidates = []
+                while len(queue) > 0 and len(candidates) < batchSize and (len(found) < k or -queue[0][0] > found[0][0]):
+                    candidates.append(heapq.heappop(queue)[1:])
+                for familyIndex,i,d in calculate(candidates):
+                    if len(found) < k:
+                        heapq.heappush(found, (d,familyIndex,i))
+                    elif d > found[0][0]:
+                        heapq.heapreplace(found, (d,familyIndex,i))
+                numCalculated += len(candidates)
+                if self.tickFunction != None:
+                    self.tickFunction(newMessage='Calculated d for %i of %i candidates...' % (numCalculated,len(counts)),increment=0)
+            found = [(f,i,d) for d,f,i in found]
+        
+        ranked = []
+        for familyIndex,i,d in found:
+            p = self.families[familyIndex][i]
+            ranked.append((p,)+counts[(familyIndex,i)]+(d,))
+        if by == 'nicki_d':
+            ranked.sort(key=lambda r: (-r[3],r[0]))
+        else:
+            ranked.sort(key=lambda r: (-r[1],r[0]))
+        return ranked
+    
+    def calculatePermutationPValues(self, numPermutations=1000, stratifyByGeneration=False, seed=0):
+        '''
+        Adds an empirical p-value for each d (nicki_d_p) by shuffling affected statuses
+        numPermutations times, optionally only within generations. Needs numpy, and needs
+        generations if stratifying (so run _countAndCalculate first)
+        '''
+        from pedigree_stats import permuteFamily
+        
+        # Whole-pedigree totals for each stratum
+        strata = {}
+        totals = []
+        for p in self.rowOrder:
+            a = self.getAttribute(p, 'affected', None)
+            if a == None:
+                continue
+            s = self.getAttribute(p, 'generation', None) if stratifyByGeneration else None
+            if not strata.has_key(s):
+                strata[s] = len(totals)
+                totals.append([0,0])
+            totals[strata[s]][0] += 1
+            if a == True:
+                totals[strata[s]][1] += 1
+        
+        def getTask(familyIndex):
+            family = self.families[familyIndex]
+            affected = [self.getAttribute(p, 'affected', None) for p in family]
+            personStrata = [strata.get(self.getAttribute(p, 'generation', None) if stratifyByGeneration else None,None) for p in family]
+            return (familyIndex, family, self._getFamilyParents(family), affected, personStrata, totals, numPermutations, seed)
+        
+        key = self._addColumn('nicki_d_p')
+        tasks = itertools.imap(getTask, xrange(len(self.families)))
+        for familyNumber,(familyIndex,pValues) in enumerate(self._mapFamilies(permuteFamily, tasks)):
+            family = self.families[familyIndex]
+            for i,p in enumerate(family):
+                self.setAttribute(p, key, pValues[i])
+            if self.tickFunction != None:
+                self.tickFunction(newMessage='Permuting family %i of %i (%i people)...' % (familyNumber+1,len(self.families),len(family)),increment=0)
+    
+    def simulateGeneDrops(self, numReplicates=1000, heritability=0.5, seed=0, chunkSize=1000):
+        '''
+        Adds null means and p-values for n_local_aff and d (n_local_aff_null, n_local_aff_drop_p,
+        nicki_d_null, nicki_d_drop_p) from gene dropping through each family, with affected
+        statuses from a liability threshold model (see pedigree_stats.dropFamily). Needs numpy
+        '''
+        from pedigree_stats import dropFamily
+        
+        def getTask(familyIndex):
+            family = self.families[familyIndex]
+            affected = [self.getAttribute(p, 'affected', None) for p in family]
+            return (familyIndex, self._getFamilyParents(family), affected, numReplicates, heritability, seed, chunkSize)
+        
+        keys = [self._addColumn(k) for k in ['n_local_aff_null','nicki_d_null','n_local_aff_drop_p','nicki_d_drop_p']]
+        tasks = itertools.imap(getTask, xrange(len(self.families)))
+        for familyNumber,(familyIndex,results) in enumerate(self._mapFamilies(dropFamily, tasks)):
+            family = self.families[familyIndex]
+            for i,p in enumerate(family):
+                for k,v in zip(keys, results[i] or [None]*len(keys)):
+                    self.setAttribute(p, k, v)
+            if self.tickFunction != None:
+                self.tickFunction(newMessage='Dropping genes through family %i of %i (%i people)...' % (familyNumber+1,len(self.families),len(family)),increment=0)
+    
+    def calculateKinship(self, people=None):
+        '''
+        Kinship coefficients between every pair of the given people (all affecteds by default),
+        one family at a time. Pairs that aren't related (including everyone in different
+        families) are left out, so anything missing from the returned {(person1,person2):phi}
+        dict is zero
+        '''
+        if people == None:
+            people = [p for p in self.rowOrder if self.getAttribute(p, 'affected', None) == True]
+        members = {}
+        for p in people:
+            members.setdefault(self.familyLookup[p],set()).add(self.familyPositions[p])
+        
+        tasks = [(f, self._getFamilyParents(self.families[f]), sorted(m)) for f,m in members.iteritems() if len(m) > 1]
+        kinship = {}
+        for familyNumber,(familyIndex,pairs) in enumerate(self._mapFamilies(_kinshipFamily, tasks)):
+            family = self.families[familyIndex]
+            if pairs == None:
+                sys.stderr.write('WARNING: Skipping kinship for the family with %s in it - someone is their own ancestor.\n' % family[0])
+                continue
+            for (a,b),phi in pairs:
+                if phi > 0:
+                    kinship[(family[a],family[b])] = phi
+            if self.tickFunction != None:
+                self.tickFunction(newMessage='Calculating kinship for family %i of %i (%i people)...' % (familyNumber+1,len(tasks),len(family)),increment=0)
+        return kinship
+    
+    def calculateEnrichment(self, strata=['generation'], test='poisson'):
+        '''
+        Compares each ancestor's n_local_aff with what their descendants' strata would predict:
+        rates of being affected come from everyone with a known status in each stratum (strata
+        are combinations of the given attributes; "attribute:width" bins a numeric one, like
+        "age:10"), and the expected count is the sum of those rates over the ancestor's
+        descendants with a known status. Adds n_local_aff_expected, n_local_aff_ratio and an
+        upper-tail p-value (n_local_aff_enrichment_p) from a Poisson or binomial test, all worked
+        out over the whole pedigree at once from the ancestry intervals. Needs numpy
+        '''
+        import numpy
+        from pedigree_stats import poissonUpperTail, binomialUpperTail
+        if test != 'poisson' and test != 'binomial':
+            raise Exception('Unknown enrichment test: %s' % test)
+        
+        binned = []
+        for s in strata:
+            if ':' in s:
+                a,width = s.split(':')
+                binned.append((a,float(width)))
+            else:
+                binned.append((s,None))
+        
+        # Binned values that aren't numbers count as missing
+        unbinnable = set()
+        def getStratum(p):
+            key = []
+            for a,width in binned:
+                v = self.getAttribute(p, a, None)
+                if width != None and v != None:
+                    try:
+                        v = math.floor(float(v)/width)
+                    except (ValueError,TypeError):
+                        unbinnable.add(a)
+                        v = None
+                key.append(v)
+            return tuple(key)
+        
+        # Everyone in one long array, family by family in their ancestry index's postorder, so that
+        # each person's descendants are a handful of contiguous runs
+        offsets = []
+        total = 0
+        for family in self.families:
+            offsets.append(total)
+            total += len(family)
+        labelled = numpy.zeros(total)
+        affected = numpy.zeros(total)
+        strataLookup = {}
+        personStrata = numpy.zeros(total, dtype=int)
+        for familyIndex,family in enumerate(self.families):
+            post = self.ancestryIndex[familyIndex][0]
+            for i,p in enumerate(family):
+                a = self.getAttribute(p, 'affected', None)
+                if a == None:
+                    continue
+                x = offsets[familyIndex]+post[i]
+                labelled[x] = 1.0
+                affected[x] = 1.0 if a == True else 0.0
+                personStrata[x] = strataLookup.setdefault(getStratum(p),len(strataLookup))
+        for a in sorted(unbinnable):
+            sys.stderr.write('WARNING: Some "%s" values aren\'t numbers - treating them as missing in the enrichment strata.\n' % a)
+        counts = numpy.bincount(personStrata, weights=labelled, minlength=len(strataLookup))
+        cases = numpy.bincount(personStrata, weights=affected, minlength=len(strataLookup))
+        rates = (cases/numpy.maximum(counts,1.0))[personStrata]*labelled
+        
+        # Descendant runs as [start,end) positions in that array
+        owners = []
+        starts = []
+        ends = []
+        for familyIndex,family in enumerate(self.families):
+            offset = offsets[familyIndex]
+            post,familyStarts,familyEnds = self.ancestryIndex[familyIndex]
+            for i in xrange(len(family)):
+                owners.extend([offset+post[i]]*len(familyStarts[i]))
+                starts.extend(offset+x for x in familyStarts[i])
+                ends.extend(offset+x+1 for x in familyEnds[i])
+        owners = numpy.array(owners, dtype=int)
+        starts = numpy.array(starts, dtype=int)
+        ends = numpy.array(ends, dtype=int)
+        
+        def descendantSums(values):
+            cumulative = numpy.concatenate([[0.0],numpy.cumsum(values)])
+            return numpy.bincount(owners, weights=cumulative[ends]-cumulative[starts], minlength=total)
+        
+        expected = descendantSums(rates)
+        observed = descendantSums(affected)
+        numLabelled = descendantSums(labelled)
+        ancestors = (descendantSums(numpy.ones(total)) > 1) & (expected > 0)
+        if test == 'poisson':
+            pValues = poissonUpperTail(observed, expected)
+        else:
+            pValues = binomialUpperTail(observed, numLabelled, expected/numpy.maximum(numLabelled,1.0))
+        
+        keys = [self._addColumn(k) for k in ['n_local_aff_expected','n_local_aff_ratio','n_local_aff_enrichment_p']]
+        for familyIndex,family in enumerate(self.families):
+            post = self.ancestryIndex[familyIndex][0]
+            for i,p in enumerate(family):
+                x = offsets[familyIndex]+post[i]
+                values = (float(expected[x]),float(observed[x]/expected[x]),float(pValues[x])) if ancestors[x] else (None,None,None)
+                for k,v in zip(keys, values):
+                    self.setAttribute(p, k, v)
+    
+    def calculateGIF(self, numResamples=1000, seed=0, chunkSize=1000):
+        '''
+        The Genealogical Index of Familiality for the affecteds: the mean kinship over every pair
+        of them, times 10^5. Its significance comes from numResamples control sets of the same
+        size, drawn (without replacement) from the people with a known status in the same
+        generation as each case. Families with an ancestry loop are left out (as if everyone in
+        them were unrelated). Returns an OrderedDict summary. Needs numpy
+        '''
+        import numpy
+        from pedigree_stats import gifFamily
+        
+        strata = {}
+        cases = []
+        for p in self.rowOrder:
+            a = self.getAttribute(p, 'affected', None)
+            if a == None:
+                continue
+            strata.setdefault(self.getAttribute(p, 'generation', None),[]).append(p)
+            if a == True:
+                cases.append(p)
+        numPairs = len(cases)*(len(cases)-1)/2
+        if numPairs == 0:
+            raise Exception('The GIF needs at least two affected people.')
+        
+        caseCounts = {}
+        for p in cases:
+            g = self.getAttribute(p, 'generation', None)
+            caseCounts[g] = caseCounts.get(g,0)+1
+        pools = []
+        for g,count in caseCounts.iteritems():
+            pool = strata[g]
+            pools.append((count, numpy.array([self.familyLookup[p] for p in pool]), numpy.array([self.familyPositions[p] for p in pool])))
+        familyCases = {}
+        for p in cases:
+            familyCases.setdefault(self.familyLookup[p],[]).append(self.familyPositions[p])
+        
+        random = numpy.random.RandomState(seed)
+        observed = 0.0
+        controls = numpy.zeros(numResamples)
+        skipped = set()
+        for start in xrange(0,numResamples,chunkSize):
+            numChunk = min(chunkSize,numResamples-start)
+            
+            # Each resample's controls, as (replicate, family, person) - every stratum at once,
+            # a few thousand rows at a time so that the random keys stay small
+            replicates = []
+            families = []
+            people = []
+            for count,poolFamilies,poolPositions in pools:
+                rows = max(1,min(numChunk,10**7/len(poolFamilies)))
+                for r in xrange(0,numChunk,rows):
+                    numRows = min(rows,numChunk-r)
+                    keys = random.random_sample((numRows,len(poolFamilies)))
+                    chosen = keys.argpartition(count-1,axis=1)[:,:count] if count < len(poolFamilies) else numpy.tile(numpy.arange(count),(numRows,1))
+                    replicates.append(numpy.repeat(numpy.arange(r,r+numRows),count))
+                    families.append(poolFamilies[chosen.ravel()])
+                    people.append(poolPositions[chosen.ravel()])
+            replicates = numpy.concatenate(replicates)
+            families = numpy.concatenate(families)
+            people = numpy.concatenate(people)
+            
+            # Only families where more than one case or control landed can add anything
+            order = families.argsort(kind='mergesort')
+            familyIndices,starts = numpy.unique(families[order], return_index=True)
+            ends = list(starts[1:])+[len(order)]
+            involved = dict((f,order[s:e]) for f,s,e in zip(familyIndices,starts,ends) if e-s > 1 and len(self.families[f]) > 1)
+            for f,c in familyCases.iteritems():
+                if len(c) > 1:
+                    involved.setdefault(f,numpy.zeros(0,dtype=int))
+            
+            def getTask(familyIndex):
+                rows = involved[familyIndex]
+                return (familyIndex, self._getFamilyParents(self.families[familyIndex]), familyCases.get(familyIndex,[]), replicates[rows], people[rows], numChunk)
+            
+            tasks = itertools.imap(getTask, sorted(involved.iterkeys()))
+            for familyNumber,(familyIndex,familyObserved,familyControls) in enumerate(self._mapFamilies(gifFamily, tasks)):
+                if familyObserved == None:
+                    skipped.add(familyIndex)
+                    continue
+                if start == 0:
+                    observed += familyObserved
+                controls[start:start+numChunk] += familyControls
+                if self.tickFunction != None:
+                    self.tickFunction(newMessage='Resampling controls in family %i of %i (%i people)...' % (familyNumber+1,len(involved),len(self.families[familyIndex])),increment=0)
+        for familyIndex in sorted(skipped):
+            sys.stderr.write('WARNING: Leaving the family with %s in it out of the GIF - someone is their own ancestor.\n' % self.families[familyIndex][0])
+        
+        gif = observed*10**5/numPairs
+        controls *= 10.0**5/numPairs
+        return OrderedDict([('cases',len(cases)),
+                            ('case_pairs',numPairs),
+                            ('generations',len(caseCounts)),
+                            ('gif',gif),
+                            ('resamples',numResamples),
+                            ('control_gif_mean',controls.mean()),
+                            ('control_gif_sd',controls.std()),
+                            ('control_gif_2.5%',numpy.percentile(controls,2.5)),
+                            ('control_gif_97.5%',numpy.percentile(controls,97.5)),
+                            ('p',(numpy.count_nonzero(controls >= gif-1e-9)+1.0)/(numResamples+1.0))])
     
     def dad(self, person):
         for parent in self.iterParents(person):
@@ -368,33 +1980,39 @@ class Pedigree(object):
     
     def iterFrom(self, person, directions=None, level=1, skipFirst=True):
         # BFS only along specified directions
+        for p,l in self.iterLevelsFrom(person, directions, level):
+            if p != person or not skipFirst:
+                yield p
+    
+    def iterLevelsFrom(self, person, directions=None, level=1):
+        # Same BFS as iterFrom, but yields (person, level) tuples, starting with (person, 0)
         if directions == None:
             directions = [Pedigree.CHILD_TO_PARENT,
                           Pedigree.PARENT_TO_CHILD,
                           Pedigree.HUSBAND_TO_WIFE,
                           Pedigree.WIFE_TO_HUSBAND]
-        toVisit = [(person,0)]
-        visited = set()
+        links = [self.links[t] for t in directions]
+        toVisit = deque([(person,0)])
+        visited = set([person])
         while len(toVisit) > 0:
-            p,l = toVisit.pop(0)
-            if p not in visited:
-                visited.add(p)
-                for p2,attrs in self.g.edge[p].iteritems():
-                    if not attrs['type'] in directions:
-                        continue
-                    if l < level:
-                        toVisit.append((p2,l+1))
-                if p != person or not skipFirst:
-                    yield p
+            p,l = toVisit.popleft()
+            if l < level:
+                for typeLinks in links:
+                    for p2 in typeLinks.get(p,()):
+                        if not p2 in visited:
+                            visited.add(p2)
+                            toVisit.append((p2,l+1))
+            yield (p,l)
     
     def iterParents(self, person):
-        return self.iterFrom(person,[Pedigree.CHILD_TO_PARENT],1,True)
+        return iter(self.links[Pedigree.CHILD_TO_PARENT].get(person,()))
     
     def iterChildren(self, person):
-        return self.iterFrom(person,[Pedigree.PARENT_TO_CHILD],1,True)
+        return iter(self.links[Pedigree.PARENT_TO_CHILD].get(person,()))
         
     def iterSpouses(self, person):
-        return self.iterFrom(person,[Pedigree.HUSBAND_TO_WIFE,Pedigree.WIFE_TO_HUSBAND],1,True)
+        return itertools.chain(self.links[Pedigree.HUSBAND_TO_WIFE].get(person,()),
+                               self.links[Pedigree.WIFE_TO_HUSBAND].get(person,()))
     
     def iterUp(self, person, level=float('inf')):
         return self.iterFrom(person,[Pedigree.CHILD_TO_PARENT],level,False)
@@ -414,24 +2032,17 @@ class Pedigree(object):
             yield (p,attrs['type'])
     
     def countNuclear(self, person):
-        parents = 0
-        spouses = 0
-        children = 0
-        for attrs in self.g.edge[person].itervalues():
-            if attrs['type'] == Pedigree.CHILD_TO_PARENT:
-                parents += 1
-            elif attrs['type'] == Pedigree.PARENT_TO_CHILD:
-                children += 1
-            else:
-                spouses += 1
+        parents = len(self.links[Pedigree.CHILD_TO_PARENT].get(person,()))
+        children = len(self.links[Pedigree.PARENT_TO_CHILD].get(person,()))
+        spouses = len(self.links[Pedigree.HUSBAND_TO_WIFE].get(person,())) + len(self.links[Pedigree.WIFE_TO_HUSBAND].get(person,()))
         return (parents,spouses,children)
     
     def iterGenerations(self,person,startingGen=0):
         # Iterates up and down BFS style, yielding tuples with the person and the generation number relative to the starting point
-        toVisit = [(person,startingGen)]
+        toVisit = deque([(person,startingGen)])
         visited = {}
         while len(toVisit) > 0:
-            p,g = toVisit.pop(0)
+            p,g = toVisit.popleft()
             if not visited.has_key(p):
                 visited[p] = g
                 for c in self.iterParents(p):
@@ -440,30 +2051,91 @@ class Pedigree(object):
                     toVisit.append((c,g+1))
                 yield (p,g)
     
-    def _findMarriageWithDefinedGeneration(self,person):
-        # Iterates up and down BFS style, returning immediately once a marriage to a person with a defined generation is detected. The blood relative (without a defined generation) and the generation number is returned
-        toVisit = [person]
-        visited = set()
+    def _assignFamilyGenerations(self, family):
+        # One BFS sweep over the family: parents are a generation up, children a generation down
+        # and spouses should match. The first person without a generation anchors the sweep,
+        # preferably via a married-in spouse that already has one. Links that disagree with what
+        # the sweep has already assigned get collected in self.generationConflicts
+        anchor = None
+        startingGen = 0
+        for p in family:
+            if self.hasAttribute(p, 'generation'):
+                continue
+            if anchor == None:
+                anchor = p
+            spouses = [s for s in self.iterSpouses(p) if self.getAttribute(s, 'generation', None) != None]
+            if len(spouses) > 0:
+                anchor = spouses[0]
+                startingGen = self.getAttribute(anchor, 'generation')
+                break
+        if anchor == None:
+            return
+        
+        generations = {anchor:startingGen}
+        finished = set()
+        toVisit = deque([anchor])
         while len(toVisit) > 0:
-            p = toVisit.pop(0)
-            if not p in visited:
-                visited.add(p)
-                for s in self.iterSpouses(p):
-                    if self.hasAttribute(s, 'generation'):
-                        return (s,self.getAttribute(s, 'generation'))
-                toVisit.extend(self.iterParents(p))
-                toVisit.extend(self.iterChildren(p))
-        return (None,None)
+            p = toVisit.popleft()
+            g = generations[p]
+            for p2,offset in itertools.chain(((p2,-1) for p2 in self.iterParents(p)),
+                                             ((p2,1) for p2 in self.iterChildren(p))):
+                if not generations.has_key(p2):
+                    generations[p2] = g+offset
+                    toVisit.append(p2)
+                elif p2 in finished and generations[p2] != g+offset:
+                    self.generationConflicts.append((p,g,p2,generations[p2]))
+            for p2 in self.iterSpouses(p):
+                if p2 in finished and generations[p2] != g:
+                    self.generationConflicts.append((p,g,p2,generations[p2]))
+            finished.add(p)
+        
+        for p,g in generations.iteritems():
+            self.setAttribute(p, 'generation', g)
+            self.maxGeneration = max(self.maxGeneration,g)
+            self.minGeneration = min(self.minGeneration,g)
     
-    def getGeneration(self, g, epsilon=0.5):
-        results = set()
-        low = g-epsilon
-        high = g+epsilon
+    def _indexGenerations(self):
+        '''
+        Sorts everyone with a generation by it (ties stay in row order), so that generation ranges
+        are a pair of binary searches, and counts up each generation's people, roots and leaves.
+        self.generationIndex is (sorted generations, the people in the same order, OrderedDict of
+        generation -> [number of people, roots, leaves])
+        '''
+        people = []
         for p in self.rowOrder:
-            g0 = self.getAttribute(p, 'generation')
-            if g0 >= low and g0 <= high:
-                results.add(p)
-        return results
+            g = self.getAttribute(p, 'generation', None)
+            if g != None:
+                people.append((g,p))
+        people.sort(key=lambda x: x[0])
+        summary = OrderedDict()
+        for g,p in people:
+            entry = summary.setdefault(g,[0,set(),set()])
+            entry[0] += 1
+            if p in self.roots:
+                entry[1].add(p)
+            if p in self.leaves:
+                entry[2].add(p)
+        self.generationIndex = ([g for g,p in people],[p for g,p in people],summary)
+    
+    def _getGenerationIndex(self):
+        if self.generationIndex == None:
+            self._indexGenerations()
+        return self.generationIndex
+    
+    def getGeneration(self, g, epsilon=0.5):
+        # Everyone whose generation is within epsilon of g
+        generations,people,summary = self._getGenerationIndex()
+        return set(people[bisect.bisect_left(generations, g-epsilon):bisect.bisect_right(generations, g+epsilon)])
+    
+    def getGenerationCounts(self):
+        # OrderedDict of generation -> number of people, in generation order
+        return OrderedDict((g,entry[0]) for g,entry in self._getGenerationIndex()[2].iteritems())
+    
+    def getGenerationRoots(self, g):
+        return set(self._getGenerationIndex()[2].get(g,(0,(),()))[1])
+    
+    def getGenerationLeaves(self, g):
+        return set(self._getGenerationIndex()[2].get(g,(0,(),()))[2])
     
     def iterEdges(self, edgeTypes={}):
         if not edgeTypes.has_key(Pedigree.PARENT_TO_CHILD):
@@ -506,6 +2178,119 @@ class Pedigree(object):
                     result.add_edge(p,p2,{'type':Pedigree.WIFE_TO_HUSBAND})
         return result
     
+    def getConnectingSet(self, people, withSpouses=False):
+        '''
+        The smallest set of people that connects the given ones through their most recent common
+        ancestors (see familyConnectingSet), family by family; people alone in their family (or
+        the only one given from it) just come back as themselves. withSpouses also adds the
+        other parent of every child in the set
+        '''
+        members = {}
+        for p in people:
+            if not self.g.node.has_key(p):
+                raise Exception("Person doesn't exist: %s" % p)
+            members.setdefault(self.familyLookup[p],set()).add(self.familyPositions[p])
+        result = set()
+        for familyIndex,targets in members.iteritems():
+            family = self.families[familyIndex]
+            parents = self._getFamilyParents(family)
+            connecting = familyConnectingSet(parents, sorted(targets))
+            if withSpouses:
+                for i in list(connecting):
+                    if any(parent in connecting for parent in parents[i]):
+                        connecting.update(parents[i])
+            result.update(family[i] for i in connecting)
+        return result
+    
+    def extractConnectingSet(self, people, withSpouses=False, edgeTypes={}):
+        return self.extractSet(self.getConnectingSet(people, withSpouses), edgeTypes)
+    
+    def classifyRelationships(self, pairs):
+        '''
+        How each (person1,person2) pair is related, in one pass: everyone's ancestor depth map
+        gets worked out once (over their family's parent arrays) and shared by every pair they're
+        in. Returns (relationship, degree, meioses1, meioses2, closest common ancestors) for each
+        pair, in order, with None for pairs that mention someone who isn't in the pedigree
+        '''
+        familyArrays = {}
+        depths = {}
+        def getDepths(p):
+            if not depths.has_key(p):
+                f = self.familyLookup[p]
+                if not familyArrays.has_key(f):
+                    parents = self._getFamilyParents(self.families[f])
+                    familyArrays[f] = (parents,familyChildren(parents))
+                depths[p] = familyAncestorDepths(familyArrays[f][0], self.familyPositions[p])
+            return depths[p]
+        
+        results = []
+        for p1,p2 in pairs:
+            if not self.g.node.has_key(p1) or not self.g.node.has_key(p2):
+                results.append(None)
+                continue
+            f = self.familyLookup[p1]
+            relationship = None
+            if self.familyLookup[p2] == f:
+                depths1 = getDepths(p1)
+                depths2 = getDepths(p2)
+                relationship = familyRelationship(familyArrays[f][1], depths1, depths2)
+            if relationship == None:
+                results.append(('unrelated',None,None,None,[]))
+                continue
+            meioses1,meioses2,closest = relationship
+            name,degree = relationshipName(meioses1, meioses2, len(closest))
+            results.append((name,degree,meioses1,meioses2,[self.families[f][a] for a in closest]))
+        return results
+    
+    def getCohorts(self, probands, up=0, down=0, withSpouses=False, maxCached=1000000):
+        '''
+        For each proband, everyone within up generations above them plus everyone within down
+        generations below any of those (through spouses too if withSpouses), as a list of IDs in
+        row order - or None if the proband isn't in the pedigree. Probands are grouped by family
+        (and split between processes if numProcesses > 1), so that the family's arrays get built
+        once and downward traversals are shared; see _cohortFamily
+        '''
+        byFamily = {}
+        for position,p in enumerate(probands):
+            if self.g.node.has_key(p):
+                byFamily.setdefault(self.familyLookup[p],[]).append((self.familyPositions[p],position))
+        # Workers map the family arrays in from shared memory if they can, instead of each batch
+        # getting its own copy
+        arrays = None
+        if self.numProcesses > 1 and len(self.families) > 1:
+            arrays = self._getSharedArrays()
+        tasks = []
+        for f,members in sorted(byFamily.iteritems()):
+            # Relatives tend to be near each other in the file, so contiguous batches share the most
+            members = [(position,i) for i,position in sorted(members)]
+            batchSize = int(math.ceil(len(members)/float(max(1,self.numProcesses))))
+            parents = arrays.path if arrays != None else self._getFamilyParents(self.families[f])
+            for start in xrange(0,len(members),batchSize):
+                tasks.append((f,parents,members[start:start+batchSize],up,down,withSpouses,maxCached))
+        
+        results = [None]*len(probands)
+        for f,familyResults in self._mapFamilies(_cohortFamily, tasks):
+            family = self.families[f]
+            for position,members in familyResults:
+                # Family members are already in row order
+                results[position] = [family[i] for i in members]
+        return results
+    
+    def getTrimmedSet(self, people=None, dropFounders=True):
+        '''
+        What's left of people (everyone by default) after trimming uninformative individuals (see
+        trimUninformative); only links between the given people count
+        '''
+        if people == None:
+            people = self.rowOrder
+        else:
+            people = set(people)
+            people = [p for p in self.rowOrder if p in people]
+        index = dict((p,i) for i,p in enumerate(people))
+        parents = [tuple(index[parent] for parent in self.iterParents(p) if index.has_key(parent)) for p in people]
+        affected = [self.getAttribute(p, 'affected', None) == True for p in people]
+        return set(p for p,k in itertools.izip(people, trimUninformative(parents, affected, dropFounders)) if k)
+    
     def getConnectedComponent(self, person, startingSet):
         toVisit = [person]
         visited = set()
@@ -518,6 +2303,16 @@ class Pedigree(object):
                         toVisit.append(p2)
         return visited
     
+    def isAncestor(self, ancestor, person):
+        # Uses the interval labels from load time instead of a BFS
+        f = self.familyLookup[ancestor]
+        if ancestor == person or self.familyLookup[person] != f:
+            return False
+        return familyIsAncestor(self.ancestryIndex[f], self.familyPositions[ancestor], self.familyPositions[person])
+    
+    def isDescendant(self, descendant, person):
+        return self.isAncestor(person, descendant)
+    
     def isRoot(self, person):
         for parent in self.iterParents(person):  # @UnusedVariable
             return False
@@ -537,11 +2332,13 @@ class Pedigree(object):
     def hasAttribute(self, p, a):
         a = Pedigree.REQUIRED_KEYS.get(a,a)
         a = Pedigree.RESERVED_KEYS.get(a,a)
+        a = Pedigree.OPTIONAL_KEYS.get(a,a)
         return self.g.node[p].has_key(a)
     
     def getAttribute(self, p, a, default=KEY_ERROR):
         a = Pedigree.REQUIRED_KEYS.get(a,a)
         a = Pedigree.RESERVED_KEYS.get(a,a)
+        a = Pedigree.OPTIONAL_KEYS.get(a,a)
         if not self.g.node[p].has_key(a) and isinstance(default,KeyError):
             raise KeyError(a)
         else:
@@ -550,7 +2347,10 @@ class Pedigree(object):
     def setAttribute(self, p, a, v):
         a = Pedigree.REQUIRED_KEYS.get(a,a)
         a = Pedigree.RESERVED_KEYS.get(a,a)
+        a = Pedigree.OPTIONAL_KEYS.get(a,a)
         self.g.node[p][a] = v
+        if a == Pedigree.RESERVED_KEYS['generation']:
+            self.generationIndex = None
     
     def getStringAttribute(self, p, a):
         value = self.getAttribute(p, a, None)
@@ -698,24 +2498,32 @@ class Pedigree(object):
             outfile.write('</gexf>')
         outfile.close()
     
-    def write_egopama(self, path):
+    def write_egopama(self, path, people=None):
+        # If people is given, only their lines get written (and parents outside of it become 0s); a
+        # list of people is taken to be in row order already, which saves looking through every row
+        rows = self.rowOrder
+        if isinstance(people,list):
+            rows = people
+            people = set(people)
         with open(path,'wb') as outfile:
             outfile.write(Pedigree.REQUIRED_KEYS['personID'])
             outfile.write('\t')
             outfile.write('\t'.join(self.extraNodeAttributes))
             outfile.write('\n')
-            for p in self.rowOrder:
+            for p in rows:
+                if people != None and not p in people:
+                    continue
                 if not isinstance(p,str):
                     print str(p)
                 outfile.write(p)
                 
                 dad = self.dad(p)
-                if dad == None:
+                if dad == None or (people != None and not dad in people):
                     dad = '0'
                 outfile.write('\t%s' % dad)
                 
                 mom = self.mom(p)
-                if mom == None:
+                if mom == None or (people != None and not mom in people):
                     mom = '0'
                 outfile.write('\t%s' % mom)
                 for a in self.extraNodeAttributes[2:]:
@@ -779,6 +2587,79 @@ class Pedigree(object):
                     a.add_edge(source,target,style='solid')
         a.draw(path,prog=program)
 
+class TraversalCache(object):
+    '''
+    Remembers the results of Pedigree traversals (iterFrom and friends), least recently used
+    first out once more than maxPeople people are being held on to in total. Each entry is one
+    BFS in visiting order plus where each level ends, so a deeper traversal also answers every
+    shallower one from the same person in the same directions. Everything gets dropped if the
+    pedigree's links change. hits and misses count how the lookups went
+    '''
+    def __init__(self, ped, maxPeople=1000000):
+        self.ped = ped
+        self.maxPeople = maxPeople
+        self.entries = OrderedDict()
+        self.numPeople = 0
+        self.linkVersion = ped.linkVersion
+        self.hits = 0
+        self.misses = 0
+    
+    def clear(self):
+        self.entries = OrderedDict()
+        self.numPeople = 0
+        self.linkVersion = self.ped.linkVersion
+    
+    def _lookup(self, person, directions, level):
+        # Returns everyone within level steps in BFS order, the person themselves first
+        if self.linkVersion != self.ped.linkVersion:
+            self.clear()
+        if directions == None:
+            directions = Pedigree.EDGE_TYPES.keys()
+        key = (person,frozenset(directions))
+        
+        if self.entries.has_key(key):
+            people,levelEnds,complete = self.entries.pop(key)
+            self.entries[key] = (people,levelEnds,complete)
+            if complete or level < len(levelEnds):
+                self.hits += 1
+                return people[:levelEnds[min(level,len(levelEnds)-1)]]
+            self.numPeople -= len(people)
+            del self.entries[key]
+        self.misses += 1
+        
+        people = []
+        levelEnds = []
+        for p,l in self.ped.iterLevelsFrom(person, directions, level):
+            while len(levelEnds) < l:
+                levelEnds.append(len(people))
+            people.append(p)
+        levelEnds.append(len(people))
+        # If the BFS ran out of people before running out of levels, we have everything
+        complete = len(levelEnds) <= level
+        
+        if len(people) <= self.maxPeople:
+            self.entries[key] = (people,levelEnds,complete)
+            self.numPeople += len(people)
+            while self.numPeople > self.maxPeople:
+                oldKey,(oldPeople,oldEnds,oldComplete) = self.entries.popitem(last=False)
+                self.numPeople -= len(oldPeople)
+        return people
+    
+    def iterFrom(self, person, directions=None, level=1, skipFirst=True):
+        people = self._lookup(person, directions, level)
+        return iter(people[1:] if skipFirst else people)
+    
+    def iterUp(self, person, level=float('inf')):
+        return self.iterFrom(person,[Pedigree.CHILD_TO_PARENT],level,False)
+    
+    def iterDown(self, person, level=float('inf')):
+        return self.iterFrom(person,[Pedigree.PARENT_TO_CHILD],level,False)
+    
+    def iterUpWithSpouses(self, person, level=float('inf')):
+        return self.iterFrom(person,[Pedigree.CHILD_TO_PARENT,Pedigree.HUSBAND_TO_WIFE,Pedigree.WIFE_TO_HUSBAND],level,False)
+    
+    def iterDownWithSpouses(self, person, level=float('inf')):
+        return self.iterFrom(person,[Pedigree.PARENT_TO_CHILD,Pedigree.HUSBAND_TO_WIFE,Pedigree.WIFE_TO_HUSBAND],level,False)
 
 '''
 General gexf notes:
@@ -0,0 +1,352 @@
+'''
+Heavier statistics that lean on numpy. Like _calculateFamily in pedigree_data, each of these
+works on one connected family at a time from a plain task tuple (people are indices into the
+family's member list), so that Pedigree can farm families out to a multiprocessing pool
+'''
+import itertools, numpy
+from pedigree_data import familyChildren, familyWithinFunction, familyMeiosesRows, familyAncestryIndex, familyIsAncestor, familyTopologicalOrder, familyInbreeding
+
+# Replicate matrices are worked on a chunk of rows at a time, with at most this many cells
+# (replicates times people) in a chunk, so that memory stays bounded however big a family is
+MAX_CHUNK_CELLS = 1 << 22
+
+def chunkRows(numRows, rowSize, chunkSize=None):
+    # (start, stop) ranges that cover numRows replicates, no more than chunkSize at a time
+    step = max(1,MAX_CHUNK_CELLS/max(rowSize,1))
+    if chunkSize != None:
+        step = min(step,chunkSize)
+    return [(start,min(numRows,start+step)) for start in xrange(0,numRows,step)]
+
+def iterAncestorWeightBlocks(parents, affected):
+    '''
+    For everyone with more than one affected descendant, yields (person, columns, weightBlocks):
+    columns are the person's labelled descendants (people with a known status, as indices into
+    the sorted list of labelled people) and weightBlocks() gives the rows of
+    W[a,b] = meioses(a,b)+1-log2(common ancestors) for them a block at a time, as (start, stop,
+    rows start:stop of W), so that for any 0/1 affected vector y over those columns,
+    d = y.W.y/2/(sum(y)-1). Blocks have at most MAX_CHUNK_CELLS cells, and distance rows are only
+    worked out for the ancestor's own descendants (see familyMeiosesRows), so neither the pair
+    distances nor W are ever held for the whole family
+    '''
+    children = familyChildren(parents)
+    descendantsOf = familyWithinFunction(children)
+    ancestry = familyAncestryIndex(parents, children)
+    
+    labelled = [i for i,a in enumerate(affected) if a != None]
+    labelledSet = set(labelled)
+    # labelled is sorted, so each labelled person's place in a distance row is their column
+    rank,row = familyMeiosesRows(parents, children, labelledSet)
+    
+    for i in xrange(len(parents)):
+        below = descendantsOf(i, float('inf'))
+        if sum(1 for p in below if affected[p] == True) <= 1:
+            continue
+        columns = numpy.array(sorted(rank[p] for p in below if p in labelledSet), dtype=int)
+        
+        # Everyone we had children with (including ourselves) could be an extra common ancestor
+        spouses = set()
+        for c in children[i]:
+            spouses.update(parents[c])
+        inSpouses = numpy.zeros((len(spouses),len(columns)))
+        for y,s in enumerate(spouses):
+            inSpouses[y] = [familyIsAncestor(ancestry, s, labelled[x]) for x in columns]
+        
+        def weightBlocks(columns=columns, inSpouses=inSpouses):
+            for start,stop in chunkRows(len(columns), len(columns)):
+                block = numpy.empty((stop-start,len(columns)))
+                for x in xrange(start,stop):
+                    block[x-start] = numpy.frombuffer(row(labelled[columns[x]]), dtype=numpy.intc)[columns]
+                commonAncestors = inSpouses[:,start:stop].T.dot(inSpouses)
+                commonAncestors += 1.0
+                block += 1.0 - numpy.log2(commonAncestors, out=commonAncestors)
+                block[numpy.arange(stop-start),numpy.arange(start,stop)] = 0.0
+                yield (start, stop, block)
+        yield (i, columns, weightBlocks)
+
+def replicateBlockD(matrices, columns, weightBlocks):
+    # d for every row of each of a list of boolean matrices (over all the labelled people), with W
+    # coming a block of rows at a time from weightBlocks (see iterAncestorWeightBlocks), so that
+    # every block gets worked out once for all of the matrices; rows with fewer than two
+    # affecteds don't have a d, and come back as -inf so that they never count as extreme
+    numAffected = [numpy.zeros(len(m)) for m in matrices]
+    sums = [numpy.zeros(len(m)) for m in matrices]
+    for start,stop,block in weightBlocks():
+        for m,matrix in enumerate(matrices):
+            for a,b in chunkRows(len(matrix), len(columns)):
+                y = matrix[a:b][:,columns]
+                sums[m][a:b] += (y[:,start:stop].astype(float).dot(block)*y).sum(axis=1)
+                if start == 0:
+                    numAffected[m][a:b] = y.sum(axis=1)
+    return [numpy.where(n > 1, total/2.0/numpy.maximum(n-1.0,1.0), -numpy.inf) for n,total in zip(numAffected, sums)]
+
+def permuteFamily(task):
+    '''
+    Empirical p-values for d under shuffled affected statuses. Shuffling the labels of the whole
+    file only matters to one family through how many affecteds land in it, so each family draws
+    that number from the hypergeometric distribution (per stratum, if stratified) and shuffles
+    its own labels. d is re-evaluated for every replicate at once: with the pairwise weights
+    W[a,b] = meioses(a,b)+1-log2(common ancestors) for an ancestor's labelled descendants, the
+    sum over affected pairs for a 0/1 replicate y is just y.W.y/2
+    '''
+    familyIndex, memberIDs, parents, affected, strata, totals, numPermutations, seed = task
+    pValues = [None]*len(memberIDs)
+    
+    # Only people with a known status get shuffled
+    labelled = [i for i,a in enumerate(affected) if a != None]
+    observed = numpy.array([[affected[i] == True for i in labelled]], dtype=bool)
+    
+    weights = iterAncestorWeightBlocks(parents, affected)
+    first = next(weights, None)
+    if first == None:
+        return (familyIndex, pValues)
+    
+    # Shuffled labels for every replicate (drawing the sort keys a chunk of rows at a time gives
+    # the same keys as drawing them all at once)
+    random = numpy.random.RandomState([seed,familyIndex])
+    replicates = numpy.zeros((numPermutations,len(labelled)), dtype=bool)
+    for s,(numPeople,numAffected) in enumerate(totals):
+        columns = numpy.array([x for x,i in enumerate(labelled) if strata[i] == s], dtype=int)
+        if len(columns) == 0:
+            continue
+        counts = random.hypergeometric(numAffected, numPeople-numAffected, len(columns), size=numPermutations)
+        for start,stop in chunkRows(numPermutations, len(columns)):
+            ranks = random.random_sample((stop-start,len(columns))).argsort(axis=1).argsort(axis=1)
+            replicates[start:stop,columns] = ranks < counts[start:stop,numpy.newaxis]
+    
+    for i,columns,weightBlocks in itertools.chain([first], weights):
+        observedD,permutedD = replicateBlockD([observed, replicates], columns, weightBlocks)
+        extreme = numpy.count_nonzero(permutedD >= observedD[0]-1e-9)
+        pValues[i] = (extreme+1.0)/(numPermutations+1.0)
+    
+    return (familyIndex, pValues)
+
+def dropGenes(parents, order, numReplicates, random):
+    '''
+    Gene dropping: every founder allele gets its own label, and each child gets one allele picked
+    at random from each parent, working down the family in generation order (an unknown parent
+    passes on a fresh founder allele). Returns a (numReplicates, people, 2) array of labels; the
+    labels for person i are 2*i and 2*i+1 if they're the ones introducing them
+    '''
+    labels = numpy.empty((numReplicates,len(parents),2), dtype=numpy.int32)
+    rows = numpy.arange(numReplicates)
+    for i in order:
+        for side in xrange(2):
+            if side < len(parents[i]):
+                p = parents[i][side]
+                labels[:,i,side] = labels[rows,p,random.randint(0,2,size=numReplicates)]
+            else:
+                labels[:,i,side] = 2*i+side
+    return labels
+
+def dropFamily(task):
+    '''
+    Null distributions of n_local_aff and d from gene dropping. Affected statuses are simulated
+    with a liability threshold model: every founder allele gets a N(0,1/2) effect, liability is
+    sqrt(heritability) times the sum of a person's two allele effects plus sqrt(1-heritability)
+    times N(0,1) noise, and the people with a known status and the highest liabilities are
+    affected, as many as are really affected in the family. Replicates are simulated at most
+    chunkSize at a time (fewer in big families, see chunkRows) and only their simulated statuses
+    are kept; ancestors' weights come a block of rows at a time (see iterAncestorWeightBlocks).
+    Returns, for everyone with more than one affected descendant, the null means of n_local_aff
+    and d (over the replicates where d exists) and the upper-tail p-values of the observed values
+    '''
+    familyIndex, parents, affected, numReplicates, heritability, seed, chunkSize = task
+    results = [None]*len(parents)
+    
+    labelled = numpy.array([i for i,a in enumerate(affected) if a != None], dtype=int)
+    observed = numpy.array([[affected[i] == True for i in labelled]], dtype=bool)
+    numAffected = int(observed.sum())
+    
+    children = familyChildren(parents)
+    order,acyclic = familyTopologicalOrder(parents, children)
+    if not acyclic:
+        return (familyIndex, results)
+    weights = iterAncestorWeightBlocks(parents, affected)
+    first = next(weights, None)
+    if first == None:
+        return (familyIndex, results)
+    
+    random = numpy.random.RandomState([seed,familyIndex])
+    replicates = numpy.zeros((numReplicates,len(labelled)), dtype=bool)
+    for start,stop in chunkRows(numReplicates, 2*len(parents), chunkSize):
+        numChunk = stop-start
+        labels = dropGenes(parents, order, numChunk, random)
+        effects = random.normal(0.0, numpy.sqrt(0.5), size=(numChunk,2*len(parents)))
+        rows = numpy.arange(numChunk)[:,numpy.newaxis]
+        genetic = effects[rows,labels[:,labelled,0]] + effects[rows,labels[:,labelled,1]]
+        liability = numpy.sqrt(heritability)*genetic + numpy.sqrt(1.0-heritability)*random.normal(size=genetic.shape)
+        ranks = (-liability).argsort(axis=1).argsort(axis=1)
+        replicates[start:stop] = ranks < numAffected
+    
+    for i,columns,weightBlocks in itertools.chain([first], weights):
+        nullAff = numpy.concatenate([replicates[a:b][:,columns].sum(axis=1) for a,b in chunkRows(numReplicates, len(columns))])
+        observedD,nullD = replicateBlockD([observed, replicates], columns, weightBlocks)
+        finite = numpy.isfinite(nullD)
+        extremeAff = numpy.count_nonzero(nullAff >= observed[0,columns].sum())
+        extremeD = numpy.count_nonzero(nullD >= observedD[0]-1e-9)
+        results[i] = (float(nullAff.sum())/numReplicates,
+                      float(nullD[finite].sum())/numpy.count_nonzero(finite) if numpy.any(finite) else None,
+                      (extremeAff+1.0)/(numReplicates+1.0),
+                      (extremeD+1.0)/(numReplicates+1.0))
+    return (familyIndex, results)
+
+def kinshipPairSums(parents, order, inbreeding, y):
+    '''
+    For every row of a 0/1 matrix y over a family's members, the sum of the kinship coefficients
+    between every pair of the chosen people, without ever building the kinship matrix. The
+    relationship matrix factors as A = 2*kinship = T.D.T' (Henderson), so y.A.y = sum(D*w^2)
+    where w = T'y is found by passing each person's weight up to their parents (half to each),
+    working from the youngest generation back; D is each person's within-family variance from
+    their parents' inbreeding coefficients (-1 for unknown parents)
+    '''
+    w = numpy.array(y, dtype=float)
+    for i in reversed(order):
+        for p in parents[i]:
+            w[:,p] += 0.5*w[:,i]
+    F = numpy.array(inbreeding)
+    D = numpy.array([0.5-0.25*sum(F[p] for p in parents[i])+0.25*(2-len(parents[i])) for i in xrange(len(parents))])
+    # y.A.y/2 counts every pair twice plus everyone's own (1+F)/2
+    return ((w*w).dot(D)/2.0-y.dot((1.0+F)/2.0))/2.0
+
+def gifFamily(task):
+    '''
+    One family's share of the Genealogical Index of Familiality: the summed kinship over pairs
+    of cases, and over pairs of the controls drawn for each resample (given as parallel arrays
+    of replicate numbers and people). Resamples are summed a chunk at a time (see chunkRows), so
+    only a few of them are ever spread out over the whole family. Both are None if the family has
+    an ancestry loop
+    '''
+    familyIndex, parents, cases, replicates, people, numReplicates = task
+    children = familyChildren(parents)
+    order,acyclic = familyTopologicalOrder(parents, children)
+    if not acyclic:
+        return (familyIndex, None, None)
+    inbreeding = familyInbreeding(parents, children)
+    
+    y = numpy.zeros((1,len(parents)))
+    y[0,cases] = 1.0
+    observed = kinshipPairSums(parents, order, inbreeding, y)[0]
+    
+    controls = numpy.zeros(numReplicates)
+    byReplicate = replicates.argsort(kind='mergesort')
+    replicates = replicates[byReplicate]
+    people = people[byReplicate]
+    for start,stop in chunkRows(numReplicates, len(parents)):
+        rows = slice(replicates.searchsorted(start),replicates.searchsorted(stop))
+        y = numpy.zeros((stop-start,len(parents)))
+        y[replicates[rows]-start,people[rows]] = 1.0
+        controls[start:stop] = kinshipPairSums(parents, order, inbreeding, y)
+    return (familyIndex, observed, controls)
+
+LANCZOS = [76.18009172947146, -86.50532032941677, 24.01409824083091, -1.231739572450155, 0.1208650973866179e-2, -0.5395239384953e-5]
+
+def gammaln(x):
+    # log(gamma(x)) for an array of positive x (Lanczos' approximation)
+    x = numpy.asarray(x, dtype=float)
+    series = numpy.ones(x.shape)*1.000000000190015
+    for j,c in enumerate(LANCZOS):
+        series += c/(x+j+1)
+    return (x+0.5)*numpy.log(x+5.5)-(x+5.5)+numpy.log(2.5066282746310005*series/x)
+
+def _continuedFraction(nextTerms, shape, maxIterations=10000, epsilon=1e-14):
+    # Modified Lentz's method for an array of continued fractions at once; nextTerms(i) gives the
+    # i-th partial numerators and denominators, and the first denominator is nextTerms(0)[1]
+    tiny = 1e-300
+    h = numpy.where(numpy.abs(nextTerms(0)[1]) < tiny, tiny, nextTerms(0)[1])
+    c = h.copy()
+    d = numpy.zeros(shape)
+    for i in xrange(1,maxIterations):
+        a,b = nextTerms(i)
+        d = b+a*d
+        d = 1.0/numpy.where(numpy.abs(d) < tiny, tiny, d)
+        c = b+a/c
+        c = numpy.where(numpy.abs(c) < tiny, tiny, c)
+        delta = c*d
+        h *= delta
+        if numpy.all(numpy.abs(delta-1.0) < epsilon):
+            break
+    return h
+
+def regularizedGamma(a, x):
+    '''
+    The regularized lower incomplete gamma function P(a,x) for arrays of a > 0 and x >= 0, from
+    its series where x < a+1 and from the continued fraction for 1-P elsewhere
+    '''
+    a,x = numpy.broadcast_arrays(numpy.asarray(a, dtype=float), numpy.asarray(x, dtype=float))
+    result = numpy.zeros(a.shape)
+    logPrefix = numpy.where(x > 0, -x+a*numpy.log(numpy.maximum(x,1e-300))-gammaln(a), -numpy.inf)
+    
+    low = (x < a+1.0) & (x > 0)
+    if numpy.any(low):
+        al = a[low]
+        xl = x[low]
+        term = 1.0/al
+        total = term.copy()
+        n = al.copy()
+        for i in xrange(10000):
+            n += 1.0
+            term *= xl/n
+            total += term
+            if numpy.all(numpy.abs(term) < numpy.abs(total)*1e-15):
+                break
+        result[low] = total*numpy.exp(logPrefix[low])
+    
+    high = x >= a+1.0
+    if numpy.any(high):
+        ah = a[high]
+        xh = x[high]
+        def terms(i):
+            if i == 0:
+                return (None, xh+1.0-ah)
+            return (-i*(i-ah), xh+1.0-ah+2.0*i)
+        fraction = 1.0/_continuedFraction(terms, ah.shape)
+        result[high] = 1.0-numpy.exp(logPrefix[high])*fraction
+    return result
+
+def regularizedBeta(x, a, b):
+    '''
+    The regularized incomplete beta function I_x(a,b) for arrays of 0 <= x <= 1 and a,b > 0,
+    from its continued fraction (on whichever side of the mean converges quickly)
+    '''
+    x,a,b = numpy.broadcast_arrays(numpy.asarray(x, dtype=float), numpy.asarray(a, dtype=float), numpy.asarray(b, dtype=float))
+    result = numpy.where(x >= 1.0, 1.0, 0.0)
+    inside = (x > 0.0) & (x < 1.0)
+    if not numpy.any(inside):
+        return result
+    x = x[inside]
+    a = a[inside]
+    b = b[inside]
+    logPrefix = gammaln(a+b)-gammaln(a)-gammaln(b)+a*numpy.log(x)+b*numpy.log(1.0-x)
+    
+    def fraction(x, a, b):
+        def terms(i):
+            if i == 0:
+                return (None, numpy.ones(x.shape))
+            m = i/2
+            if i % 2 == 0:
+                numerator = m*(b-m)*x/((a+2.0*m-1.0)*(a+2.0*m))
+            else:
+                numerator = -(a+m)*(a+b+m)*x/((a+2.0*m)*(a+2.0*m+1.0))
+            return (numerator, numpy.ones(x.shape))
+        return _continuedFraction(terms, x.shape)
+    
+    direct = x < (a+1.0)/(a+b+2.0)
+    values = numpy.empty(x.shape)
+    if numpy.any(direct):
+        values[direct] = numpy.exp(logPrefix[direct])/fraction(x[direct], a[direct], b[direct])/a[direct]
+    flipped = ~direct
+    if numpy.any(flipped):
+        values[flipped] = 1.0-numpy.exp(logPrefix[flipped])/fraction(1.0-x[flipped], b[flipped], a[flipped])/b[flipped]
+    result[inside] = values
+    return result
+
+def poissonUpperTail(k, mu):
+    # P(X >= k) for X ~ Poisson(mu), element-wise
+    k,mu = numpy.broadcast_arrays(numpy.asarray(k, dtype=float), numpy.asarray(mu, dtype=float))
+    return numpy.where(k <= 0, 1.0, regularizedGamma(numpy.maximum(k,1.0), mu))
+
+def binomialUpperTail(k, n, p):
+    # P(X >= k) for X ~ Binomial(n, p), element-wise
+    k,n,p = numpy.broadcast_arrays(numpy.asarray(k, dtype=float), numpy.asarray(n, dtype=float), numpy.asarray(p, dtype=float))
+    tail = regularizedBeta(p, numpy.maximum(k,1.0), numpy.maximum(n-k+1.0,1.0))
+    return numpy.where(k <= 0, 1.0, numpy.where(k > n, 0.0, tail))
@@ -0,0 +1,123 @@
+'''
+A loaded pedigree's core arrays, saved as .npy files in a directory (under /dev/shm if there is
+one) that worker processes - or queue workers on other hosts - can map in read-only, instead of
+having the same family arrays pickled over to each of them. People are numbered family by
+family: family f's members are ids[familyStarts[f]:familyStarts[f+1]], in the same order as
+Pedigree.families[f], and parent / child indices are family positions, so slicing out a family
+gives the same arrays as Pedigree._getFamilyParents
+'''
+import os, shutil, tempfile, atexit, cPickle, numpy
+
+class SharedPedigreeArrays(object):
+    ARRAYS = ['ids','sortedIDs','sortedOrder','familyStarts','parentStarts','parentIndices','childStarts','childIndices']
+    
+    # Everything this process has attached to, by path, so that each worker only maps them once
+    attached = {}
+    
+    def __init__(self, path, owner=False):
+        self.path = path
+        self.owner = owner
+        for a in SharedPedigreeArrays.ARRAYS:
+            setattr(self, a, numpy.load(os.path.join(path,a+'.npy'), mmap_mode='r'))
+        with open(os.path.join(path,'columns.pickle'),'rb') as infile:
+            # Column name -> (file number, None) for numeric columns (NaN where missing), or (file
+            # number, category names) for categorical columns, whose codes are -1 where missing
+            self.columns = cPickle.load(infile)
+    
+    @staticmethod
+    def publish(ped, attributes=None, path=None):
+        '''
+        Writes ped's arrays, plus columns for the given attributes (every extra column by default),
+        to path (a new temporary directory by default, which gets removed when this process exits)
+        '''
+        owner = path == None
+        if owner:
+            path = tempfile.mkdtemp(prefix='pedigree_arrays_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            atexit.register(shutil.rmtree, path, True)
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+        if attributes == None:
+            # The parent columns are already in the parent / child arrays
+            links = [ped.REQUIRED_KEYS['paID'],ped.REQUIRED_KEYS['maID']]
+            attributes = [a for a in ped.extraNodeAttributes if not a in links]
+        
+        people = [p for family in ped.families for p in family]
+        familyStarts = numpy.cumsum([0]+[len(family) for family in ped.families])
+        parents = []
+        children = []
+        for family in ped.families:
+            familyParents = ped._getFamilyParents(family)
+            familyChildren = [[] for p in family]
+            for i,ps in enumerate(familyParents):
+                for j in ps:
+                    familyChildren[j].append(i)
+            parents.extend(familyParents)
+            children.extend(familyChildren)
+        ids = numpy.array(people)
+        sortedOrder = numpy.argsort(ids, kind='mergesort')
+        arrays = {'ids':ids,
+                  'sortedIDs':ids[sortedOrder],
+                  'sortedOrder':sortedOrder,
+                  'familyStarts':familyStarts,
+                  'parentStarts':numpy.cumsum([0]+[len(ps) for ps in parents]),
+                  'parentIndices':numpy.array([j for ps in parents for j in ps], dtype=numpy.int32),
+                  'childStarts':numpy.cumsum([0]+[len(cs) for cs in children]),
+                  'childIndices':numpy.array([j for cs in children for j in cs], dtype=numpy.int32)}
+        
+        columns = {}
+        for number,a in enumerate(attributes):
+            values = [ped.getAttribute(p, a, None) for p in people]
+            try:
+                arrays['column.%i' % number] = numpy.array([numpy.nan if v == None else float(v) for v in values])
+                columns[a] = (number,None)
+            except (ValueError,TypeError):
+                categories = sorted(set(v for v in values if v != None))
+                codes = dict((c,x) for x,c in enumerate(categories))
+                arrays['column.%i' % number] = numpy.array([-1 if v == None else codes[v] for v in values], dtype=numpy.int32)
+                columns[a] = (number,categories)
+        
+        for a,array in arrays.iteritems():
+            numpy.save(os.path.join(path,a+'.npy'), array)
+        with open(os.path.join(path,'columns.pickle'),'wb') as outfile:
+            cPickle.dump(columns, outfile, cPickle.HIGHEST_PROTOCOL)
+        result = SharedPedigreeArrays(path, owner)
+        SharedPedigreeArrays.attached[path] = result
+        return result
+    
+    @staticmethod
+    def attach(path):
+        if not SharedPedigreeArrays.attached.has_key(path):
+            SharedPedigreeArrays.attached[path] = SharedPedigreeArrays(path)
+        return SharedPedigreeArrays.attached[path]
+    
+    def close(self):
+        SharedPedigreeArrays.attached.pop(self.path, None)
+        if self.owner:
+            shutil.rmtree(self.path, True)
+    
+    def lookup(self, personID):
+        # Index of the person (in family order), or None if they aren't in the pedigree
+        x = numpy.searchsorted(self.sortedIDs, personID)
+        if x >= len(self.sortedIDs) or self.sortedIDs[x] != personID:
+            return None
+        return int(self.sortedOrder[x])
+    
+    def familyMembers(self, familyIndex):
+        return self.ids[self.familyStarts[familyIndex]:self.familyStarts[familyIndex+1]].tolist()
+    
+    def _familyLinks(self, familyIndex, starts, indices):
+        offsets = starts[self.familyStarts[familyIndex]:self.familyStarts[familyIndex+1]+1].tolist()
+        links = indices[offsets[0]:offsets[-1]].tolist()
+        return [tuple(links[s-offsets[0]:e-offsets[0]]) for s,e in zip(offsets[:-1],offsets[1:])]
+    
+    def familyParents(self, familyIndex):
+        # The same as Pedigree._getFamilyParents(ped.families[familyIndex])
+        return self._familyLinks(familyIndex, self.parentStarts, self.parentIndices)
+    
+    def familyChildren(self, familyIndex):
+        return [list(cs) for cs in self._familyLinks(familyIndex, self.childStarts, self.childIndices)]
+    
+    def column(self, a):
+        # The column's values in family order (see self.columns for how to read them)
+        number,categories = self.columns[a]
+        return numpy.load(os.path.join(self.path,'column.%i.npy' % number), mmap_mode='r')
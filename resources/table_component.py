@@ -109,6 +109,12 @@ class TableComponent(QTableWidget,AppComponent):
         if nIndex != None:
             self.headerObj.updateSection(nIndex)
     
+    def notifySortBy(self, attribute, descending):
+        for i in xrange(self.numColumns+1):
+            if self.horizontalHeaderItem(i).text() == attribute:
+                self.sortItems(i, Qt.DescendingOrder if descending else Qt.AscendingOrder)
+                break
+    
     def notifyHighlightAnIndividual(self, previous, new):
         if previous != None:
             self.colorRow(previous)
@@ -0,0 +1,194 @@
+'''
+A work queue that lives in a directory, so that workers on any host that can see it (over a shared
+filesystem) can pitch in without any extra services. Each unit of work is a pickled (function,
+task) pair. Units move between subdirectories with os.rename, which is atomic, so only one worker
+can claim each one: todo -> claimed (touched every so often while someone works on it) -> done.
+The coordinator puts units that failed, or whose worker stopped touching them, back in todo
+'''
+import os, sys, time, socket, gzip, cPickle, traceback, threading
+
+class WorkQueue(object):
+    SUBDIRECTORIES = ['todo','claimed','done','failed']
+    
+    def __init__(self, path, timeout=600, maxAttempts=3):
+        # Claimed units that haven't been touched for timeout seconds are taken to be abandoned;
+        # a unit that fails maxAttempts times fails the whole job
+        self.path = path
+        self.timeout = timeout
+        self.maxAttempts = maxAttempts
+        self.attempts = {}
+        self.owner = '%s.%i' % (socket.gethostname(),os.getpid())
+        for d in WorkQueue.SUBDIRECTORIES:
+            try:
+                os.makedirs(os.path.join(path,d))
+            except OSError:
+                # Someone else may have just made it
+                if not os.path.isdir(os.path.join(path,d)):
+                    raise
+    
+    def _path(self, directory, name):
+        return os.path.join(self.path,directory,name)
+    
+    def _write(self, path, state):
+        # Write somewhere private first, so that nobody ever sees half a file
+        tempPath = '%s.%s.tmp' % (path,self.owner)
+        with gzip.open(tempPath,'wb') as outfile:
+            cPickle.dump(state, outfile, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tempPath, path)
+    
+    def _read(self, path):
+        with gzip.open(path,'rb') as infile:
+            return cPickle.load(infile)
+    
+    def _list(self, directory):
+        return sorted(n for n in os.listdir(os.path.join(self.path,directory)) if not n.endswith('.tmp'))
+    
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    
+    # Coordinator side
+    
+    def start(self, signature):
+        '''
+        Gets the queue ready for a job; finished units are kept if the queue was last used for a job
+        with the same signature (so that a coordinator can be restarted), otherwise everything goes
+        '''
+        # Workers go by the timeout in the job file, so that they know how often to touch their units
+        jobPath = os.path.join(self.path,'job')
+        if os.path.exists(jobPath) and self._read(jobPath)[0] == signature:
+            self._remove(os.path.join(self.path,'finished'))
+            self._write(jobPath, (signature,self.timeout))
+            return
+        for d in WorkQueue.SUBDIRECTORIES:
+            for n in os.listdir(os.path.join(self.path,d)):
+                self._remove(self._path(d,n))
+        self._remove(os.path.join(self.path,'finished'))
+        self._write(jobPath, (signature,self.timeout))
+    
+    def put(self, name, function, task):
+        # Names need to sort in the order the units should be worked on; units that are already
+        # done or under way are left alone
+        if os.path.exists(self._path('done',name)) or os.path.exists(self._path('todo',name)) or \
+           any(n.rsplit('@',1)[0] == name for n in self._list('claimed')):
+            return
+        self._write(self._path('todo',name), (function,task))
+    
+    def collect(self, names):
+        # Results for any of the names that are done, as (name, result) tuples
+        for n in self._list('done'):
+            if n in names:
+                yield (n,self._read(self._path('done',n)))
+    
+    def discard(self, name):
+        # Throws away a finished unit's results, so that it can be put again
+        self._remove(self._path('done',name))
+    
+    def requeue(self):
+        # Puts failed and abandoned units back in todo; returns how many there were
+        numRequeued = 0
+        for n in self._list('failed'):
+            if n.endswith('.error'):
+                continue
+            errorPath = self._path('failed',n+'.error')
+            error = open(errorPath,'rb').read() if os.path.exists(errorPath) else 'unknown error'
+            self.attempts[n] = self.attempts.get(n,0)+1
+            if self.attempts[n] >= self.maxAttempts:
+                raise Exception('Work unit %s failed %i times; the last error was:\n%s' % (n,self.attempts[n],error))
+            sys.stderr.write('WARNING: Work unit %s failed - trying again. The error was:\n%s\n' % (n,error))
+            os.rename(self._path('failed',n), self._path('todo',n))
+            self._remove(errorPath)
+            numRequeued += 1
+        now = time.time()
+        for n in self._list('claimed'):
+            try:
+                if now - os.path.getmtime(self._path('claimed',n)) < self.timeout:
+                    continue
+                os.rename(self._path('claimed',n), self._path('todo',n.rsplit('@',1)[0]))
+            except OSError:
+                # It just finished (or failed)
+                continue
+            sys.stderr.write('WARNING: %s gave up on work unit %s - trying again.\n' % tuple(n.rsplit('@',1)[::-1]))
+            numRequeued += 1
+        return numRequeued
+    
+    def finish(self):
+        # Tells the workers that there's nothing more coming, and clears out the results
+        with open(os.path.join(self.path,'finished'),'wb') as outfile:
+            outfile.write(self.owner)
+        for d in WorkQueue.SUBDIRECTORIES:
+            for n in os.listdir(os.path.join(self.path,d)):
+                self._remove(self._path(d,n))
+        self._remove(os.path.join(self.path,'job'))
+    
+    # Worker side
+    
+    def claim(self):
+        # Returns the name of a unit that this worker now owns, or None if there aren't any
+        for n in self._list('todo'):
+            try:
+                os.rename(self._path('todo',n), self._path('claimed','%s@%s' % (n,self.owner)))
+            except OSError:
+                # Someone else got there first
+                continue
+            # Renaming doesn't count as touching it
+            try:
+                os.utime(self._path('claimed','%s@%s' % (n,self.owner)), None)
+            except OSError:
+                continue
+            return n
+        return None
+    
+    def run(self, name):
+        # Works on a claimed unit, touching it every so often so that the coordinator knows we're on it
+        claimedPath = self._path('claimed','%s@%s' % (name,self.owner))
+        jobPath = os.path.join(self.path,'job')
+        if os.path.exists(jobPath):
+            self.timeout = self._read(jobPath)[1]
+        stop = threading.Event()
+        def touch():
+            while not stop.wait(self.timeout/4.0):
+                try:
+                    os.utime(claimedPath, None)
+                except OSError:
+                    return
+        toucher = threading.Thread(target=touch)
+        toucher.daemon = True
+        toucher.start()
+        try:
+            function,task = self._read(claimedPath)
+            result = function(task)
+        except KeyboardInterrupt:
+            stop.set()
+            if os.path.exists(claimedPath):
+                os.rename(claimedPath, self._path('todo',name))
+            raise
+        except Exception:
+            stop.set()
+            if os.path.exists(claimedPath):
+                with open(self._path('failed',name+'.error'),'wb') as outfile:
+                    outfile.write('%s: %s' % (self.owner,traceback.format_exc()))
+                os.rename(claimedPath, self._path('failed',name))
+            return False
+        stop.set()
+        self._write(self._path('done',name), result)
+        self._remove(claimedPath)
+        return True
+    
+    def work(self, wait=5):
+        '''
+        Claims and runs units until the coordinator says the job's finished, checking for new
+        units every wait seconds in the meantime; returns how many units were done
+        '''
+        numDone = 0
+        while True:
+            name = self.claim()
+            if name == None:
+                if os.path.exists(os.path.join(self.path,'finished')):
+                    return numDone
+                time.sleep(wait)
+                continue
+            if self.run(name):
+                numDone += 1
@@ -28,7 +28,8 @@ class loading(object):
                          'nicki_d':self.window.nicki_d,
                          'is_root':self.window.is_root,
                          'is_leaf':self.window.is_leaf,
-                         'generation':self.window.generation}
+                         'generation':self.window.generation,
+                         'inbreeding':self.window.inbreeding}
         self.requiredForCalculateD = set(['personID','paID','maID','sex','affected'])
         self.header = []
         self.lowerHeader = []
@@ -137,6 +138,14 @@ class loading(object):
                 if t == '':
                     t = k
             Pedigree.RESERVED_KEYS[k] = t
+        for k in Pedigree.OPTIONAL_KEYS.keys():
+            # Older files won't have these, so they're never required
+            if not self.overrides.has_key(k):
+                continue
+            t = self.overrides[k].currentText()
+            if t == '':
+                t = k
+            Pedigree.OPTIONAL_KEYS[k] = t
         
         try:
             if self.window.programBox.currentText() == 'vis':